@@ -0,0 +1,53 @@
+"""
+Coalescing, diff based broadcasts to the SockJS sessions of a component
+"""
+import asyncio
+import logging
+
+import sockjs
+from sockjs.protocol import message_frame
+
+from common import app
+
+COALESCE_WINDOW = 0.25
+
+logger = logging.getLogger(__name__)
+
+class DiffBroadcaster:
+    """
+    Collects change notifications for a short window and then broadcasts one frame with
+    only the fields of snapshot() that differ from the previous frame. Newly opened
+    sessions get the full snapshot on their own.
+    """
+    def __init__(self, managerName, snapshot, window=COALESCE_WINDOW):
+        self.managerName = managerName
+        self.snapshot = snapshot
+        self.window = window
+        self.lastSent = {}
+        self.frames = 0
+        self._manager = None
+        self._pending = None
+
+    @property
+    def manager(self):
+        if self._manager is None:
+            self._manager = sockjs.get_manager(self.managerName, app)
+        return self._manager
+
+    def changed(self):
+        if self._pending is None:
+            self._pending = asyncio.get_event_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        self._pending = None
+        details = self.snapshot()
+        diff = {key: value for (key, value) in details.items() if key not in self.lastSent or self.lastSent[key] != value}
+        self.lastSent = details
+        if diff:
+            self.frames += 1
+            self.manager.broadcast(diff)
+
+    def sendSnapshot(self, session):
+        # Framed like the broadcasts, so the client gets an object either way
+        # (Session.send only takes strings, which arrive as strings)
+        session.send_frame(message_frame(self.snapshot()))
@@ -0,0 +1,66 @@
+"""
+Calibration of sensor readings
+
+A Calibration maps raw readings to true values through a curve of calibration
+points, each a raw reading and the true value it should read as (e.g. measured in
+an ice bath and in boiling water). Between points the curve is linear, and beyond
+the outermost points it carries on along the nearest segment. A single point is an
+offset, and a sensor's offset setting is added on top of the curve:
+
+    calibration:
+      - [0.4, 0.0]
+      - [99.1, 100.0]
+"""
+from bisect import bisect_right
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class Calibration:
+    def __init__(self, points=(), offset=0.0):
+        points = sorted((float(raw), float(true)) for (raw, true) in points)
+        if len(set(raw for (raw, true) in points)) != len(points):
+            raise ValueError('Calibration points must have distinct raw readings: %s'%points)
+        self.raws = [raw for (raw, true) in points]
+        self.trues = [true for (raw, true) in points]
+        self.offset = offset
+        if len(points) == 1:
+            self.offset += self.trues[0] - self.raws[0]
+            self.raws = []
+            self.trues = []
+
+    def apply(self, value):
+        if not self.raws:
+            return value + self.offset
+        # The segment the value falls in, or the nearest one outside of the points
+        i = min(max(bisect_right(self.raws, value), 1), len(self.raws) - 1)
+        (x0, x1) = (self.raws[i - 1], self.raws[i])
+        (y0, y1) = (self.trues[i - 1], self.trues[i])
+        return y0 + (value - x0)*(y1 - y0)/(x1 - x0) + self.offset
+
+    def applyMany(self, values):
+        """
+        Calibrates a sequence of readings, returning a NumPy array when NumPy is installed
+        """
+        if numpy is None:
+            return [self.apply(value) for value in values]
+        values = numpy.asarray(values, dtype=float)
+        if not self.raws:
+            return values + self.offset
+        calibrated = numpy.interp(values, self.raws, self.trues)
+        # numpy.interp holds the end values, extend the outer segments instead
+        (x0, x1, xn1, xn) = (self.raws[0], self.raws[1], self.raws[-2], self.raws[-1])
+        (y0, y1, yn1, yn) = (self.trues[0], self.trues[1], self.trues[-2], self.trues[-1])
+        below = values < x0
+        above = values > xn
+        calibrated[below] = y0 + (values[below] - x0)*(y1 - y0)/(x1 - x0)
+        calibrated[above] = yn + (values[above] - xn)*(yn - yn1)/(xn - xn1)
+        return calibrated + self.offset
+
+def fromSettings(settings):
+    """
+    Makes the calibration configured in a sensor's settings (calibration and offset)
+    """
+    return Calibration(settings.get('calibration', ()), settings.get('offset', 0.0))
@@ -1,4 +1,3 @@
-import asyncio
 import logging
 from collections import deque
 from time import time
@@ -10,14 +9,22 @@ import sockjs
 import interfaces
 import event
 from common import app, components
+from history import History, Rollups, HISTORY_SIZE, packColumns, jsonColumns
+from timeseries import TimeSeriesStore
+from downsample import downsampleColumns
+from broadcast import DiffBroadcaster
+from scheduler import scheduler
 
-HISTORY_SIZE = 300
+CONTROL_INTERVAL = 10.0
+
+# Number of buckets resolution=auto aims for when no maxPoints is given
+AUTO_RESOLUTION_POINTS = 500
 
 logger = logging.getLogger(__name__)
 
 
 class Controller(interfaces.Component, interfaces.Runnable):
-    def __init__(self, name, sensor, actor, logic, agitator=None, targetTemp=0.0, initiallyEnabled=False):
+    def __init__(self, name, sensor, actor, logic, agitator=None, targetTemp=0.0, initiallyEnabled=False, historySize=HISTORY_SIZE, historyFile=None, interval=CONTROL_INTERVAL):
         self.name = name
         self._enabled = initiallyEnabled
         self._autoMode = False
@@ -26,18 +33,21 @@ class Controller(interfaces.Component, interfaces.Runnable):
         self.agitator = agitator
         self.targetTemp = targetTemp
         self.logic = logic
+        self.sensor.setpointChanged(targetTemp)
 
-        self.timestamp_history = list ()
-        self.power_history = list ()
-        self.temp_history = list ()
-        self.gravity_history =  list ()
-        self.setpoint_history = list ()
+        # Resolved once, every declared channel is recorded on each tick
+        self.channels = self.sensor.channelReaders()
+        columns = ['power', 'setpoint'] + [channel for (channel, reader) in self.channels]
+        self.history = History(columns, historySize)
+        self.rollups = Rollups(columns)
+        self.store = TimeSeriesStore(historyFile, columns) if historyFile else None
+        self.lastSampleTime = None
 
+        self.broadcaster = DiffBroadcaster('%s-ws'%self.name, self.getDetails)
         sockjs.add_endpoint(app, prefix='/controllers/%s/ws'%self.name, name='%s-ws'%self.name, handler=self.websocket_handler)
-        asyncio.ensure_future(self.run())
+        scheduler.add(self.name, self.tick, interval, delay=5)
 
     def callback(self, endpoint, data):
-        includeSetpoint = False
         if endpoint in ['state', 'enabled']:
             self.enabled = bool(data)
             self.actor.updatePower(0.0)
@@ -48,7 +58,6 @@ class Controller(interfaces.Component, interfaces.Runnable):
             logger.info("Setting %s ctrl automatic to %r"%(self.name, bool(self._autoMode)))
         elif endpoint == 'setpoint':
             self.setSetpoint(float(data))
-            includeSetpoint = True
         elif endpoint == 'power':
             self.actor.updatePower(float(data))
             logger.info("Setting %s ctrl power to %f"%(self.name, float(data)))
@@ -59,18 +68,17 @@ class Controller(interfaces.Component, interfaces.Runnable):
         else:
             self.logic.callback(endpoint, data)
             #logger.warning("Unknown type/endpoint for Contorller %s"%endpoint)
-        self.broadcastDetails(includeSetpoint)        
+        self.broadcastDetails()
 
     def setSetpoint(self, setpoint):
         self.targetTemp = setpoint
+        self.sensor.setpointChanged(setpoint)
         event.notify(event.Event(source=self.name, endpoint='setpoint', data=self.targetTemp))
 
-    def broadcastDetails(self, includeSetpoint=False):
-        manager = sockjs.get_manager('%s-ws'%self.name, app)
-        details = self.getDetails()
-        if not includeSetpoint:
-            details.pop('setpoint', None)
-        manager.broadcast(details)
+    def broadcastDetails(self):
+        # Only changed fields are sent, so the setpoint no longer has to be held back
+        # to keep from overwriting a setpoint being typed in the web UI
+        self.broadcaster.changed()
 
 
     @property
@@ -101,61 +109,40 @@ class Controller(interfaces.Component, interfaces.Runnable):
             'power': self.actor.getPower(),
             'agitating': self.agitator.getPower()>0 if self.agitator else None,
             'enabled': self.enabled,
-            'wsUrl': '/controllers/%s/ws'%self.name
+            'wsUrl': '/controllers/%s/ws'%self.name,
+            # Server time of the newest history sample, for incremental history fetches
+            'timestamp': self.lastSampleTime
         }
-        if ('gravity' in dir (self.sensor)):
-            details['gravity'] = self.sensor.gravity ()
+        for (channel, reader) in self.channels:
+            details[channel] = reader()
         return details
 
-    ## This returns the position i such that (ar[i] - ar[i-1]) + (ar[i+1] -
-    ## ar[i]) is minimal.
-    @staticmethod
-    def mostredundanttime (ar):
-        mint = float ('inf')
-        minpos = -1
-        for i in range (1, len (ar) - 1):
-            delta = ar[i + 1] - ar[i - 1]
-            if delta < mint:
-                mint = delta
-                minpos = i
-        return minpos
-
-    async def run(self):
-        await asyncio.sleep(5)
-        while True:
-            output = self.actor.getPower()
-            print ("Enabled: %d, auto: %d"%(self.enabled, self._autoMode))
-            if self.enabled:
-                if self._autoMode:
-                    output = self.logic.calc(self.sensor.temp(), self.targetTemp)
-                self.actor.updatePower(output)
-            self.broadcastDetails()
-
-            self.timestamp_history.append(time())
-            self.power_history.append(output)
-            self.temp_history.append(self.sensor.temp())
-            self.setpoint_history.append(self.targetTemp)
-
-            if ('gravity' in dir (self.sensor)):
-                self.gravity_history.append (self.sensor.gravity ())
-
-            if len (self.timestamp_history) == HISTORY_SIZE + 1:
-                i = self.mostredundanttime (self.timestamp_history)
-                assert i > 0 and i < HISTORY_SIZE
-                del self.timestamp_history[i]
-                del self.power_history[i]
-                del self.temp_history[i]
-                del self.setpoint_history[i]
-                if ('gravity' in dir (self.sensor)):
-                    del self.gravity_history[i]
-
-            await asyncio.sleep(10)
-
-
+    def tick(self):
+        output = self.actor.getPower()
+        logger.debug("%s enabled: %d, auto: %d", self.name, self.enabled, self._autoMode)
+        if self.enabled:
+            if self._autoMode:
+                output = self.logic.calc(self.sensor.temp(), self.targetTemp)
+            self.actor.updatePower(output)
+        self.broadcastDetails()
+
+        sample = {
+            'timestamp': time(),
+            'power': output,
+            'setpoint': self.targetTemp
+        }
+        for (channel, reader) in self.channels:
+            value = reader()
+            sample[channel] = value if value is not None else float('nan')
+        self.history.append(sample)
+        self.lastSampleTime = sample['timestamp']
+        self.rollups.add(sample)
+        if self.store is not None:
+            self.store.append(sample)
 
     async def websocket_handler(self, msg, session):
         if msg.type == sockjs.MSG_OPEN:
-            self.broadcastDetails()
+            self.broadcaster.sendSnapshot(session)
         if msg.type == sockjs.MSG_MESSAGE:
             data = json.loads(msg.data)
             for endpoint, value in data.items():
@@ -180,17 +167,38 @@ async def dataHistory(request):
     try:
         controllerName = request.match_info['name']
         controller = components[controllerName]
-        data = {
-            'label': list(controller.timestamp_history),
-            'temperature': list(controller.temp_history),
-            'power': list(controller.power_history),
-            'setpoint': list(controller.setpoint_history)
-            }
-        if ('gravity' in dir (controller.sensor)):
-            data['gravity'] = list (controller.gravity_history)
-        return web.json_response(data)
     except KeyError as e:
         raise web.HTTPNotFound(reason='Unknown controller %s'%str(e))
+    try:
+        start = float(request.query['from']) if 'from' in request.query else None
+        end = float(request.query['to']) if 'to' in request.query else None
+        since = float(request.query['since']) if 'since' in request.query else None
+        maxPoints = int(request.query['maxPoints']) if 'maxPoints' in request.query else None
+    except ValueError as e:
+        raise web.HTTPBadRequest(reason='Malformed query %s'%str(e))
+    binary = request.query.get('format') == 'binary' or 'application/octet-stream' in request.headers.get('Accept', '')
+    resolution = request.query.get('resolution')
+    if resolution:
+        if resolution == 'auto':
+            rollup = controller.rollups.select(start, end if end is not None else time(), maxPoints or AUTO_RESOLUTION_POINTS)
+        elif resolution in controller.rollups.resolutions:
+            rollup = controller.rollups.resolutions[resolution]
+        else:
+            raise web.HTTPBadRequest(reason='Unknown resolution %s'%resolution)
+        data = rollup.range(start, end, since)
+    elif controller.store is not None and (start is not None or end is not None):
+        data = controller.store.range(start, end, since)
+    else:
+        data = controller.history.columns(since)
+    if not binary:
+        # Missing readings and empty rollup buckets are NaN
+        data = jsonColumns(data)
+    data = dict(label=data.pop('timestamp'), **data)
+    if maxPoints:
+        data = downsampleColumns(data, maxPoints)
+    if binary:
+        return web.Response(body=packColumns(data), content_type='application/octet-stream')
+    return web.json_response(data)
 
 
 app.router.add_get('/controllers', listControllers)
@@ -0,0 +1,120 @@
+"""
+Largest-Triangle-Three-Buckets downsampling of history series
+
+The series are split into buckets of equal sample count and from each bucket the
+sample forming the largest triangle with the sample kept from the previous bucket
+and the average of the next bucket is kept. Several series sharing one time axis are
+reduced together, each normalized by its range and their triangle areas summed, so
+they keep a common set of timestamps. The selection is done with NumPy when it is
+installed, vectorized within each bucket, and in plain Python otherwise.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def bucketBounds(count, threshold):
+    """
+    Returns threshold-1 bucket boundaries for the samples between the first and last one
+    """
+    every = (count - 2)/(threshold - 2)
+    return [int(i*every) + 1 for i in range(threshold - 1)]
+
+def lttb(x, series, threshold):
+    """
+    Returns the indices of at most threshold samples to keep from x and the series
+    (a list of sequences as long as x), first and last sample included
+    """
+    count = len(x)
+    if threshold >= count or threshold < 3:
+        return list(range(count))
+    if numpy is not None:
+        return _lttbNumpy(x, series, threshold)
+    return _lttbPython(x, series, threshold)
+
+def _lttbNumpy(x, series, threshold):
+    x = numpy.asarray(x, dtype=float)
+    ys = numpy.nan_to_num(numpy.array(series, dtype=float, ndmin=2))
+    spans = ys.max(axis=1) - ys.min(axis=1)
+    ys /= numpy.where(spans > 0, spans, 1.0)[:, None]
+    count = len(x)
+    bounds = bucketBounds(count, threshold) + [count]
+    starts = numpy.array(bounds)
+    # Averages of every bucket, the last bucket being the final sample on its own
+    sizes = numpy.diff(starts)
+    xAvg = numpy.add.reduceat(x, starts[:-1])/sizes
+    yAvg = (numpy.add.reduceat(ys, starts[:-1], axis=1)/sizes).T.copy()
+    # One row per sample, so that a bucket is a contiguous block
+    ys = ys.T.copy()
+
+    selected = [0]
+    a = 0
+    for bucket in range(threshold - 2):
+        lo = bounds[bucket]
+        hi = bounds[bucket + 1]
+        xa = x[a]
+        ya = ys[a]
+        areas = numpy.abs((xa - xAvg[bucket + 1])*(ys[lo:hi] - ya) - (xa - x[lo:hi])[:, None]*(yAvg[bucket + 1] - ya)).sum(axis=1)
+        a = lo + int(areas.argmax())
+        selected.append(a)
+    selected.append(count - 1)
+    return selected
+
+def _lttbPython(x, series, threshold):
+    normalized = []
+    for ys in series:
+        ys = [0.0 if y is None or y != y else y for y in ys]
+        span = max(ys) - min(ys)
+        normalized.append([y/span for y in ys] if span > 0 else ys)
+    bounds = bucketBounds(len(x), threshold) + [len(x)]
+
+    selected = [0]
+    a = 0
+    for bucket in range(threshold - 2):
+        lo = bounds[bucket]
+        hi = bounds[bucket + 1]
+        nextHi = bounds[bucket + 2]
+        xa = x[a]
+        xc = sum(x[hi:nextHi])/(nextHi - hi)
+        ycs = [sum(ys[hi:nextHi])/(nextHi - hi) for ys in normalized]
+        maxArea = -1.0
+        for i in range(lo, hi):
+            area = sum(abs((xa - xc)*(ys[i] - ys[a]) - (xa - x[i])*(yc - ys[a])) for (ys, yc) in zip(normalized, ycs))
+            if area > maxArea:
+                maxArea = area
+                best = i
+        a = best
+        selected.append(a)
+    selected.append(len(x) - 1)
+    return selected
+
+def downsampleColumns(columns, threshold, timeColumn='label'):
+    """
+    Reduces a dict of equally long columns to at most threshold samples
+    """
+    x = columns[timeColumn]
+    if threshold >= len(x):
+        return columns
+    series = [values for (name, values) in columns.items() if name != timeColumn]
+    indices = lttb(x, series, threshold)
+    if numpy is not None:
+        return {name: numpy.asarray(values)[indices].tolist() for (name, values) in columns.items()}
+    return {name: [values[i] for i in indices] for (name, values) in columns.items()}
+
+if __name__ == '__main__':
+    import math
+    import time
+    from array import array
+
+    # Columns as TimeSeriesStore.range returns them
+    count = 100000
+    x = array('d', (10.0*i for i in range(count)))
+    series = [array('d', (18 + math.sin(i/500.0) + 0.1*math.sin(i) for i in range(count))),
+              array('d', (100.0*(i//700 % 2) for i in range(count))),
+              array('d', [18.0])*count,
+              array('d', (1.050 - 0.04*i/count for i in range(count)))]
+    for threshold in (500, 2000):
+        start = time.perf_counter()
+        indices = lttb(x, series, threshold)
+        elapsed = time.perf_counter() - start
+        print("%d points -> %d: %.1f ms (%s)"%(count, len(indices), 1000*elapsed, 'numpy' if numpy else 'python'))
@@ -1,6 +1,6 @@
 import asyncio
 import logging
-from collections import namedtuple
+from collections import namedtuple, deque
 
 logger = logging.getLogger(__name__)
 
@@ -11,16 +11,310 @@ def name(event):
 
 Event.name = name
 
-observers = {}
+DROP_OLDEST = 'drop-oldest'
+COALESCE_LATEST = 'coalesce-latest'
+BLOCK = 'block'
+OVERFLOW_POLICIES = (DROP_OLDEST, COALESCE_LATEST, BLOCK)
 
-def register(eventName, callback):
-    observers.setdefault(eventName, []).append(callback)
+class QueuedObserver:
+    """
+    Runs an observer from its own consumer task, fed through a bounded queue, so that
+    a slow observer never runs on the publisher's stack
+
+    When the queue is full the overflow policy decides what happens:
+    drop-oldest discards the oldest queued value, coalesce-latest replaces the newest
+    queued value and block parks the value until the consumer has made room. At most
+    queueSize values are parked, further ones are dropped, so a stuck consumer holds
+    on to a bounded number of values. notify() never waits; an async publisher can
+    await publish() to wait for room instead of having its values parked.
+
+    With a PublishPolicy only the values it passes on are queued.
+    """
+    def __init__(self, callback, queueSize, overflow=DROP_OLDEST, label=None, policy=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy %s'%overflow)
+        if queueSize < 1:
+            raise ValueError('queueSize must be at least 1')
+        self.callback = callback
+        self.queueSize = queueSize
+        self.overflow = overflow
+        self.label = label or repr(callback)
+        self.policy = policy
+        self.queue = deque()
+        self.parked = deque()
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.blocked = 0
+        self._isCoroutine = asyncio.iscoroutinefunction(callback)
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self.task = asyncio.ensure_future(self.consume())
+
+    def put(self, data):
+        if self.policy is not None:
+            self.policy.offer(None, data, data, self.enqueue)
+        else:
+            self.enqueue(data)
+
+    def enqueue(self, data):
+        if len(self.queue) < self.queueSize:
+            self.queue.append(data)
+            if len(self.queue) == self.queueSize:
+                self._space.clear()
+        elif self.overflow == DROP_OLDEST:
+            self.queue.popleft()
+            self.queue.append(data)
+            self.dropped += 1
+        elif self.overflow == COALESCE_LATEST:
+            self.queue[-1] = data
+            self.coalesced += 1
+        elif len(self.parked) < self.queueSize:
+            self.parked.append(data)
+            self.blocked += 1
+        else:
+            self.dropped += 1
+        self._wakeup.set()
+
+    async def waitForSpace(self):
+        while self.overflow == BLOCK and len(self.queue) >= self.queueSize:
+            await self._space.wait()
+
+    async def consume(self):
+        while True:
+            while not self.queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            data = self.queue.popleft()
+            if self.parked:
+                self.queue.append(self.parked.popleft())
+            if len(self.queue) < self.queueSize:
+                self._space.set()
+            try:
+                if self._isCoroutine:
+                    await self.callback(data)
+                else:
+                    self.callback(data)
+            except Exception:
+                logger.exception("Observer %s failed", self.label)
+            self.delivered += 1
+
+    def stats(self):
+        return {
+            'observer': self.label,
+            'policy': self.overflow,
+            'queueSize': self.queueSize,
+            'depth': len(self.queue) + len(self.parked),
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'blocked': self.blocked
+        }
+
+class PublishPolicy:
+    """
+    Decides which values of an event stream are worth passing on, to cut traffic
+    from sensors that sample faster than their readings change
+
+    A value is passed on when it differs from the last one passed on by more than
+    deadband, or by more than relativeDeadband times that value, but not sooner than
+    minInterval after it: a change arriving earlier is held back and passed on (the
+    latest one) once minInterval is over, so no change is lost. Every value arriving
+    heartbeat seconds or more after the last one passed on is passed on, changed or
+    not. Values that are not numbers are passed on whenever they are different.
+    """
+    def __init__(self, deadband=0.0, relativeDeadband=0.0, minInterval=0.0, heartbeat=None):
+        self.deadband = deadband
+        self.relativeDeadband = relativeDeadband
+        self.minInterval = minInterval
+        self.heartbeat = heartbeat
+        self.last = {}
+        self.held = {}
+        self.passed = 0
+        self.suppressed = 0
+
+    def changed(self, last, value):
+        try:
+            return abs(value - last) > max(self.deadband, self.relativeDeadband*abs(last))
+        except TypeError:
+            return value != last
+
+    def offer(self, key, value, item, deliver):
+        """
+        Offers the value of the stream key, calling deliver(item) if it is passed on
+        """
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        last = self.last.get(key)
+        if last is None:
+            return self._pass(key, value, item, deliver, now)
+        (lastValue, lastTime) = last
+        elapsed = now - lastTime
+        if self.heartbeat is not None and elapsed >= self.heartbeat:
+            return self._pass(key, value, item, deliver, now)
+        if not self.changed(lastValue, value):
+            self.suppressed += 1
+            if key in self.held:
+                # Back within the deadband of what was passed on, nothing to catch up on
+                self.held.pop(key)[0].cancel()
+            return
+        if elapsed >= self.minInterval:
+            return self._pass(key, value, item, deliver, now)
+        self.suppressed += 1
+        if key in self.held:
+            self.held[key][1:] = [value, item, deliver]
+        else:
+            self.held[key] = [loop.call_at(lastTime + self.minInterval, self._release, key), value, item, deliver]
+
+    def _pass(self, key, value, item, deliver, now):
+        if key in self.held:
+            self.held.pop(key)[0].cancel()
+        self.last[key] = (value, now)
+        self.passed += 1
+        deliver(item)
+
+    def _release(self, key):
+        (handle, value, item, deliver) = self.held.pop(key)
+        self.suppressed -= 1
+        self._pass(key, value, item, deliver, asyncio.get_event_loop().time())
+
+    def stats(self):
+        return {'passed': self.passed, 'suppressed': self.suppressed, 'held': len(self.held)}
+
+def policyFromSettings(settings):
+    """
+    Makes a PublishPolicy from a dict of its settings (deadband, relativeDeadband,
+    minInterval, heartbeat)
+    """
+    return PublishPolicy(settings.get('deadband', 0.0), settings.get('relativeDeadband', 0.0),
+                         settings.get('minInterval', 0.0), settings.get('heartbeat'))
+
+# Publish policies of sources, (source, endpoint) or (source, None) for all its endpoints -> PublishPolicy
+policies = {}
+
+def setPolicy(source, policy, endpoint=None):
+    """
+    Filters the events a source publishes, on one endpoint or all, through policy
+    before they reach any observer
+    """
+    policies[(source, endpoint)] = policy
+
+class Route:
+    """
+    Observers of one (source, endpoint) pair, split by kind when they are registered
+    so that notify does not have to inspect them again
+    """
+    __slots__ = ('syncObservers', 'asyncObservers', 'queuedObservers')
+
+    def __init__(self):
+        self.syncObservers = ()
+        self.asyncObservers = ()
+        self.queuedObservers = ()
+
+    def add(self, callback):
+        if isinstance(callback, QueuedObserver):
+            self.queuedObservers += (callback,)
+        elif asyncio.iscoroutinefunction(callback):
+            self.asyncObservers += (callback,)
+        else:
+            self.syncObservers += (callback,)
+
+# Dispatch table, (source, endpoint) -> Route
+routes = {}
+
+def register(eventName, callback, queueSize=0, overflow=DROP_OLDEST, label=None, policy=None):
+    """
+    Registers callback for eventName ("source.endpoint"). With a queueSize the callback
+    is decoupled from the publisher through a QueuedObserver. With a PublishPolicy only
+    the values it passes on reach this callback.
+    """
+    (source, endpoint) = eventName.split('.', 1)
+    route = routes.setdefault((source, endpoint), Route())
+    if policy is not None:
+        connectionPolicies.append((label or eventName, policy))
+    if queueSize:
+        # The policy sits in front of the queue, which stays visible to queueStats and publish
+        callback = QueuedObserver(callback, queueSize, overflow, label or eventName, policy)
+        route.add(callback)
+        return callback
+    if policy is None:
+        route.add(callback)
+        return callback
+    if asyncio.iscoroutinefunction(callback):
+        deliver = lambda data, callback=callback: asyncio.ensure_future(callback(data))
+    else:
+        deliver = callback
+    route.add(lambda data: policy.offer(None, data, data, deliver))
+    return callback
+
+# (label, PublishPolicy) of the observers registered with a policy
+connectionPolicies = []
 
 def notify(event):
-    logger.debug("notify %s"%str(event))
-    if event.name() in observers:
-        for observer in observers[event.name()]:
-            if asyncio.iscoroutinefunction(observer):
-                asyncio.ensure_future(observer(event.data))
-            else:
-                observer(event.data)
+    route = routes.get((event.source, event.endpoint))
+    if route is None:
+        return
+    if policies:
+        policy = policies.get((event.source, event.endpoint)) or policies.get((event.source, None))
+        if policy is not None:
+            policy.offer(event.endpoint, event.data, event, _dispatch)
+            return
+    _dispatch(event)
+
+def _dispatch(event):
+    logger.debug("notify %s", event)
+    route = routes[(event.source, event.endpoint)]
+    for observer in route.syncObservers:
+        observer(event.data)
+    for observer in route.asyncObservers:
+        asyncio.ensure_future(observer(event.data))
+    for observer in route.queuedObservers:
+        observer.put(event.data)
+
+async def publish(event):
+    """
+    Like notify, but waits for room in the queues of blocking observers first
+    """
+    route = routes.get((event.source, event.endpoint))
+    if route is None:
+        return
+    for observer in route.queuedObservers:
+        await observer.waitForSpace()
+    notify(event)
+
+def queueStats():
+    return [observer.stats() for route in routes.values() for observer in route.queuedObservers]
+
+def policyStats():
+    stats = {'%s.%s'%(source, endpoint or '*'): policy.stats() for ((source, endpoint), policy) in policies.items()}
+    stats.update((label, policy.stats()) for (label, policy) in connectionPolicies)
+    return stats
+
+if __name__ == '__main__':
+    # Micro-benchmark of the notify hot path: a string keyed lookup with per call
+    # coroutine inspection (the previous implementation) against the dispatch table
+    import timeit
+
+    legacyObservers = {}
+
+    def legacyNotify(event):
+        logger.debug("notify %s"%str(event))
+        if event.name() in legacyObservers:
+            for observer in legacyObservers[event.name()]:
+                if asyncio.iscoroutinefunction(observer):
+                    asyncio.ensure_future(observer(event.data))
+                else:
+                    observer(event.data)
+
+    logging.basicConfig(level=logging.INFO)
+    sink = lambda data: None
+    for i in range(50):
+        register('Sensor%d.temperature'%i, sink)
+        legacyObservers.setdefault('Sensor%d.temperature'%i, []).append(sink)
+    events = [Event(source='Sensor%d'%i, endpoint=endpoint, data=20.0) for i in range(50) for endpoint in ('temperature', 'gravity')]
+
+    count = 2000
+    for (label, func) in (('before', legacyNotify), ('after', notify)):
+        elapsed = timeit.timeit(lambda: [func(e) for e in events], number=count)
+        print("%-6s %10.0f events/s"%(label, count*len(events)/elapsed))
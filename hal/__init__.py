@@ -0,0 +1,48 @@
+"""
+Hardware abstraction layer
+
+Plugins reach their hardware (GPIO pins, SPI devices, the 1-Wire bus and Bluetooth
+HCI devices) through the modules of this package, each of which has a real backend
+and a simulated one. The simulated backends need no hardware and model the timing
+of the devices they stand in for (e.g. the 750 ms conversion of a DS18B20), so that
+a production configuration can be run and profiled on any machine with
+
+    hal:
+      backend: simulated
+      values:
+        28-000004b8240b: 66.0
+
+values sets what simulated sensors measure, keyed by the id the sensor is configured
+with (see the simulated backend of each module for the keys it uses).
+"""
+REAL = 'real'
+SIMULATED = 'simulated'
+
+backend = REAL
+simulatedValues = {}
+
+def configure(settings):
+    """
+    Selects the backend from the hal section of the configuration, either just the
+    name of the backend or a dict with backend and values
+    """
+    global backend
+    if isinstance(settings, str):
+        settings = {'backend': settings}
+    name = settings.get('backend', REAL)
+    if name not in (REAL, SIMULATED):
+        raise ValueError('Unknown hal backend %s, expected %s or %s'%(name, REAL, SIMULATED))
+    backend = name
+    simulatedValues.update(settings.get('values', {}))
+
+def simulated():
+    return backend == SIMULATED
+
+def simulate(key, value):
+    """
+    Sets what the simulated device known as key measures from now on
+    """
+    simulatedValues[key] = value
+
+def simulatedValue(key, default):
+    return simulatedValues.get(key, default)
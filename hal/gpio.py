@@ -0,0 +1,53 @@
+"""
+GPIO outputs driven by software PWM
+
+The real backend uses RPi.GPIO with BCM pin numbering. The simulated one keeps the
+duty cycle of every pin, and when it last changed, in pins.
+"""
+import time
+
+import hal
+
+class RealPWM:
+    def __init__(self, pin, frequency):
+        import RPi.GPIO as GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(pin, GPIO.OUT)
+        self.pwm = GPIO.PWM(pin, frequency)
+
+    def start(self, duty):
+        self.pwm.start(duty)
+
+    def changeDutyCycle(self, duty):
+        self.pwm.ChangeDutyCycle(duty)
+
+    def stop(self):
+        self.pwm.stop()
+
+class SimulatedPWM:
+    def __init__(self, pin, frequency):
+        self.pin = pin
+        self.frequency = frequency
+        self.duty = None
+        self.changed = None
+        self.changes = 0
+        pins[pin] = self
+
+    def start(self, duty):
+        self.changeDutyCycle(duty)
+
+    def changeDutyCycle(self, duty):
+        self.duty = duty
+        self.changed = time.monotonic()
+        self.changes += 1
+
+    def stop(self):
+        self.changeDutyCycle(0.0)
+
+pins = {}
+
+def openPWM(pin, frequency):
+    """
+    Returns a PWM output on the (BCM numbered) pin, not started yet
+    """
+    return SimulatedPWM(pin, frequency) if hal.simulated() else RealPWM(pin, frequency)
@@ -0,0 +1,131 @@
+"""
+Bluetooth HCI devices scanning for LE advertisements
+
+recv returns raw HCI event packets. Once scanning is enabled, the socket's filter only
+lets LE meta events through, so the process is not woken up for any other HCI
+traffic. Devices can be made non-blocking and watched with loop.add_reader.
+
+The simulated backend advertises an iBeacon for every Tilt colour set in the
+simulated values, as (temperature in degrees C, specific gravity), a Red Tilt at
+20 C and 1.050 if none is set, each once every ADVERTISING_INTERVAL. The
+advertisements are sent from the event loop through a socket pair, so the simulated
+device has a file descriptor like a real one.
+"""
+import asyncio
+import socket
+import struct
+
+import hal
+
+OGF_LE_CTL = 0x08
+OCF_LE_SET_SCAN_PARAMETERS = 0x000B
+OCF_LE_SET_SCAN_ENABLE = 0x000C
+HCI_EVENT_PKT = 0x04
+LE_META_EVENT = 0x3e
+EVT_LE_ADVERTISING_REPORT = 0x02
+ADV_NONCONN_IND = 0x03
+
+class RealDevice:
+    def __init__(self, devId):
+        import bluetooth._bluetooth as bluez
+        self.bluez = bluez
+        self.sock = bluez.hci_open_dev(devId)
+
+    def enableScan(self):
+        bluez = self.bluez
+        bluez.hci_send_cmd(self.sock, OGF_LE_CTL, OCF_LE_SET_SCAN_ENABLE, struct.pack('<BB', 0x01, 0x00))
+        flt = bluez.hci_filter_new()
+        bluez.hci_filter_clear(flt)
+        bluez.hci_filter_set_ptype(flt, bluez.HCI_EVENT_PKT)
+        bluez.hci_filter_set_event(flt, LE_META_EVENT)
+        self.sock.setsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, flt)
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def recv(self, size=255):
+        return self.sock.recv(size)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+TILT_UUIDS = {
+    'Red': 'a495bb10c5b14b44b5121370f02d74de',
+    'Green': 'a495bb20c5b14b44b5121370f02d74de',
+    'Black': 'a495bb30c5b14b44b5121370f02d74de',
+    'Purple': 'a495bb40c5b14b44b5121370f02d74de',
+    'Orange': 'a495bb50c5b14b44b5121370f02d74de',
+    'Blue': 'a495bb60c5b14b44b5121370f02d74de',
+    'Yellow': 'a495bb70c5b14b44b5121370f02d74de',
+    'Pink': 'a495bb80c5b14b44b5121370f02d74de',
+}
+
+def advertisingReport(address, uuid, major, minor, txPower=-59, rssi=-70):
+    """
+    Builds the HCI LE advertising report event of an iBeacon
+    """
+    data = (b'\x02\x01\x04\x1a\xff\x4c\x00\x02\x15' + bytes.fromhex(uuid) +
+            struct.pack('>HHb', major, minor, txPower))
+    report = (struct.pack('<BBB', 1, ADV_NONCONN_IND, 0) + address + struct.pack('<B', len(data)) +
+              data + struct.pack('<b', rssi))
+    return struct.pack('<BBBB', HCI_EVENT_PKT, LE_META_EVENT, len(report) + 1, EVT_LE_ADVERTISING_REPORT) + report
+
+class SimulatedDevice:
+    ADVERTISING_INTERVAL = 1.0
+
+    def __init__(self, devId):
+        self.devId = devId
+        (self.sock, self.radio) = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.radio.setblocking(False)
+        self.loop = asyncio.get_event_loop()
+        self.handle = None
+        self.started = None
+        self.sent = 0
+
+    def enableScan(self):
+        self.started = self.loop.time()
+        self.scheduleNext()
+
+    def beacons(self):
+        tilts = [(colour, hal.simulatedValues[colour]) for colour in sorted(TILT_UUIDS) if colour in hal.simulatedValues]
+        return tilts or [('Red', (20.0, 1.050))]
+
+    def scheduleNext(self):
+        """
+        Schedules the next advertisement, the tilts taking turns
+        """
+        due = self.started + (self.sent + 1)*self.ADVERTISING_INTERVAL/len(self.beacons())
+        self.handle = self.loop.call_at(due, self.advertise)
+
+    def advertise(self):
+        beacons = self.beacons()
+        (colour, (temperature, gravity)) = beacons[self.sent % len(beacons)]
+        self.sent += 1
+        address = bytes([0x10 + sorted(TILT_UUIDS).index(colour), 0, 0, 0, 0, 0xc0])
+        try:
+            self.radio.send(advertisingReport(address, TILT_UUIDS[colour], int(round(temperature*1.8 + 32)), int(round(gravity*1000))))
+        except BlockingIOError:
+            # Nobody reading, dropped like by a full socket buffer
+            pass
+        self.scheduleNext()
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def recv(self, size=255):
+        return self.sock.recv(size)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.cancel()
+        self.sock.close()
+        self.radio.close()
+
+def openDevice(devId=0):
+    return SimulatedDevice(devId) if hal.simulated() else RealDevice(devId)
@@ -0,0 +1,125 @@
+"""
+SPI devices
+
+Each bus has one worker thread, and transfer runs the transfers of all devices on
+the bus there, one at a time, so that blocking SPI I/O neither interleaves nor ties
+up the event loop's default executor. The real backend uses spidev. The simulated backend emulates the chip named by
+model, so far the MAX31865 RTD converter, whose simulated value is keyed by
+spi<bus>.<device>. Transfers take as long as they would at the configured clock.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import hal
+from rtd import resistance
+
+workers = {}
+
+def worker(bus):
+    if bus not in workers:
+        workers[bus] = ThreadPoolExecutor(max_workers=1)
+    return workers[bus]
+
+class Device:
+    async def transfer(self, data):
+        """
+        Runs xfer in the worker thread of the bus
+        """
+        return await asyncio.get_event_loop().run_in_executor(worker(self.bus), self.xfer, data)
+
+class RealDevice(Device):
+    def __init__(self, bus, device, mode, speedHz, **modelSettings):
+        import spidev
+        self.bus = bus
+        self.spi = spidev.SpiDev()
+        self.spi.open(bus, device)
+        self.spi.mode = mode
+        self.spi.max_speed_hz = speedHz
+
+    def xfer(self, data):
+        return self.spi.xfer(data)
+
+    def close(self):
+        self.spi.close()
+
+class SimulatedMAX31865:
+    """
+    MAX31865 with a platinum RTD at the simulated temperature (20.0 C if unset). A
+    conversion is ready SETTLE_TIME after a one-shot is triggered; reading earlier
+    returns the previous conversion. With automatic conversion on, the first conversion
+    is ready SETTLE_TIME after it is enabled and the RTD registers follow the
+    temperature from then on.
+    """
+    SETTLE_TIME = 0.1
+    REGISTERS = 8
+
+    def __init__(self, key, rref=430.0, r0=100.0):
+        self.key = key
+        self.rref = rref
+        self.r0 = r0
+        self.registers = [0]*self.REGISTERS
+        self.registers[3:5] = [0xFF, 0xFF]
+        self.pending = None
+
+    def convert(self):
+        temperature = hal.simulatedValue(self.key, 20.0)
+        code = min(0x7FFF, int(resistance(temperature, self.r0)/self.rref*32768))
+        self.registers[1:3] = [code >> 7, (code << 1) & 0xFF]
+
+    def update(self):
+        now = time.monotonic()
+        if self.pending is not None and now >= self.pending:
+            self.pending = None
+            self.convert()
+        elif self.pending is None and self.registers[0] & 0xC0 == 0xC0:
+            self.convert()
+
+    def xfer(self, data):
+        self.update()
+        address = data[0] & 0x7F
+        reply = [0xFF]
+        for (i, value) in enumerate(data[1:]):
+            register = (address + i) % self.REGISTERS
+            if data[0] & 0x80:
+                if register == 0:
+                    if value & 0x20 or (value & 0xC0 == 0xC0 and self.registers[0] & 0xC0 != 0xC0):
+                        self.pending = time.monotonic() + self.SETTLE_TIME
+                    value &= ~0x22
+                self.registers[register] = value
+                reply.append(0xFF)
+            else:
+                reply.append(self.registers[register])
+        return reply
+
+MODELS = {'max31865': SimulatedMAX31865}
+
+class SimulatedDevice(Device):
+    def __init__(self, bus, device, mode, speedHz, model, **modelSettings):
+        self.bus = bus
+        if model not in MODELS:
+            raise ValueError('Cannot simulate SPI device %d.%d of model %s'%(bus, device, model))
+        self.speedHz = speedHz
+        self.chip = MODELS[model]('spi%d.%d'%(bus, device), **modelSettings)
+        # Like the kernel driver, one transfer at a time on a bus
+        self.lock = buses.setdefault(bus, threading.Lock())
+
+    def xfer(self, data):
+        with self.lock:
+            time.sleep(8*len(data)/self.speedHz)
+            return self.chip.xfer(list(data))
+
+    def close(self):
+        pass
+
+buses = {}
+
+def openDevice(bus, device, mode=0, speedHz=500000, model=None, **modelSettings):
+    """
+    Opens an SPI device. model names the chip to emulate with the simulated backend,
+    modelSettings are passed on to its model.
+    """
+    if hal.simulated():
+        return SimulatedDevice(bus, device, mode, speedHz, model, **modelSettings)
+    return RealDevice(bus, device, mode, speedHz)
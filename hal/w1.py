@@ -0,0 +1,133 @@
+"""
+The Linux 1-Wire bus
+
+Reading w1_slave makes the kernel trigger a temperature conversion and wait for it,
+750 ms for a DS18B20 at 12 bit resolution, and conversions of devices on the same
+master are serialized. Writing trigger to a master's therm_bulk_read instead starts
+the conversion of all its thermometers at once, after which each temperature can be
+read without waiting (w1_therm in Linux 5.10 and later).
+
+The simulated bus takes as long, without blocking the event loop, and answers with
+the w1_slave text the kernel would give for the simulated value of the device id (a
+temperature in degrees C, 20.0 if unset). The ids of configured sensors (see attach)
+and ids set in the simulated values that look like 1-Wire ids are the devices on its
+single master.
+"""
+import asyncio
+import os
+import re
+
+import hal
+
+W1_DEVICES = '/sys/bus/w1/devices'
+CONVERSION_TIME = 0.75
+DEVICE_ID = re.compile('^[0-9a-f]{2}-[0-9a-f]{12}$')
+
+class RealBus:
+    async def readFile(self, *path):
+        import aiofiles
+        async with aiofiles.open(os.path.join(W1_DEVICES, *path), mode='r') as f:
+            return await f.read()
+
+    async def read(self, sensorId):
+        return await self.readFile(sensorId, 'w1_slave')
+
+    def attach(self, sensorId):
+        # The kernel lists the devices it finds
+        pass
+
+    def masters(self):
+        try:
+            return sorted(name for name in os.listdir(W1_DEVICES) if name.startswith('w1_bus_master'))
+        except FileNotFoundError:
+            return []
+
+    def devices(self, master=None):
+        try:
+            names = os.listdir(os.path.join(W1_DEVICES, master) if master else W1_DEVICES)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if DEVICE_ID.match(name))
+
+    async def bulkConvert(self, master):
+        """
+        Converts the temperature of all thermometers on master at once. Returns False
+        if the kernel does not support bulk conversion.
+        """
+        path = os.path.join(W1_DEVICES, master, 'therm_bulk_read')
+        if not os.path.exists(path):
+            return False
+        import aiofiles
+        async with aiofiles.open(path, mode='w') as f:
+            await f.write('trigger\n')
+        await asyncio.sleep(CONVERSION_TIME)
+        # -1 while a conversion is still in progress
+        while (await self.readFile(master, 'therm_bulk_read')).strip() == '-1':
+            await asyncio.sleep(0.05)
+        return True
+
+    async def readTemperature(self, sensorId):
+        """
+        Returns the temperature in millidegrees C, the one converted by the last bulk
+        conversion if there was one
+        """
+        contents = await self.readFile(sensorId, 'temperature')
+        try:
+            return int(contents)
+        except ValueError:
+            raise RuntimeError("Failed to read W1 Temperature of %s: %s"%(sensorId, contents))
+
+def slaveText(millidegrees):
+    """
+    Formats a reading the way the kernel's w1_therm driver does
+    """
+    raw = millidegrees*16//1000 & 0xFFFF
+    data = '%02x %02x 4b 46 7f ff 0c 10'%(raw & 0xFF, raw >> 8)
+    return '%s 1c : crc=1c YES\n%s 1c t=%d\n'%(data, data, millidegrees)
+
+class SimulatedBus:
+    MASTER = 'w1_bus_master1'
+
+    def __init__(self):
+        self.converted = {}
+        self.conversions = 0
+        self.attached = set()
+
+    def millidegrees(self, sensorId):
+        return int(round(1000*hal.simulatedValue(sensorId, 20.0)))
+
+    async def convert(self, sensorIds):
+        await asyncio.sleep(CONVERSION_TIME)
+        self.conversions += 1
+        for sensorId in sensorIds:
+            self.converted[sensorId] = self.millidegrees(sensorId)
+
+    async def read(self, sensorId):
+        await self.convert([])
+        return slaveText(self.millidegrees(sensorId))
+
+    def masters(self):
+        return [self.MASTER]
+
+    def attach(self, sensorId):
+        self.attached.add(sensorId)
+
+    def devices(self, master=None):
+        return sorted(self.attached.union(key for key in hal.simulatedValues if DEVICE_ID.match(key)))
+
+    async def bulkConvert(self, master):
+        await self.convert(self.devices(master))
+        return True
+
+    async def readTemperature(self, sensorId):
+        if sensorId not in self.converted:
+            await self.convert([sensorId])
+        return self.converted.pop(sensorId)
+
+_bus = None
+
+def bus():
+    global _bus
+    if _bus is None:
+        _bus = SimulatedBus() if hal.simulated() else RealBus()
+    return _bus
@@ -0,0 +1,327 @@
+"""
+Columnar, fixed capacity sample history for controllers
+
+Once full, every append evicts the most redundant sample, i.e. the one whose
+neighbours are closest together in time, which thins out the densest region of the
+history while keeping its full time span. Samples live in preallocated array('d')
+columns and are chained in time order through prev/next links, and the candidate
+gaps are kept in a heap, so both finding and evicting that sample is O(log n).
+
+For long batches Rollups keeps min/max/mean aggregates at minute, hour and day
+resolution next to it.
+"""
+import heapq
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+
+HISTORY_SIZE = 300
+
+class History:
+    def __init__(self, columns, size=HISTORY_SIZE, timeColumn='timestamp'):
+        if size < 3:
+            raise ValueError('History size must be at least 3')
+        self.size = size
+        self.timeColumn = timeColumn
+        self.columnNames = [timeColumn] + [name for name in columns if name != timeColumn]
+        capacity = size + 1
+        self._columns = {name: array('d', bytes(8*capacity)) for name in self.columnNames}
+        self._time = self._columns[timeColumn]
+        self._prev = array('l', [-1])*capacity
+        self._next = array('l', [-1])*capacity
+        self._seq = array('q', [0])*capacity
+        self._version = array('l', [0])*capacity
+        self._free = list(range(capacity-1, -1, -1))
+        self._heap = []
+        self._head = -1
+        self._tail = -1
+        self._count = 0
+        self._nextSeq = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, values):
+        """
+        Adds a sample, values maps column names to numbers. Missing columns are stored as NaN.
+        """
+        slot = self._free.pop()
+        for (name, column) in self._columns.items():
+            column[slot] = values.get(name, float('nan'))
+        self._seq[slot] = self._nextSeq
+        self._nextSeq += 1
+        self._version[slot] += 1
+        self._prev[slot] = self._tail
+        self._next[slot] = -1
+        if self._tail >= 0:
+            self._next[self._tail] = slot
+            self._pushGap(self._tail)
+        else:
+            self._head = slot
+        self._tail = slot
+        self._count += 1
+
+        if self._count > self.size:
+            self._evict(self._popMostRedundant())
+
+    def _pushGap(self, slot):
+        prev = self._prev[slot]
+        nxt = self._next[slot]
+        if prev < 0 or nxt < 0:
+            return
+        gap = self._time[nxt] - self._time[prev]
+        heapq.heappush(self._heap, (gap, self._seq[slot], slot, self._version[slot]))
+        if len(self._heap) > 4*self.size:
+            self._rebuildHeap()
+
+    def _rebuildHeap(self):
+        self._heap = []
+        slot = self._next[self._head]
+        while slot >= 0 and self._next[slot] >= 0:
+            self._heap.append((self._time[self._next[slot]] - self._time[self._prev[slot]], self._seq[slot], slot, self._version[slot]))
+            slot = self._next[slot]
+        heapq.heapify(self._heap)
+
+    def _popMostRedundant(self):
+        while True:
+            (gap, seq, slot, version) = heapq.heappop(self._heap)
+            if self._version[slot] == version:
+                return slot
+
+    def _evict(self, slot):
+        prev = self._prev[slot]
+        nxt = self._next[slot]
+        self._next[prev] = nxt
+        self._prev[nxt] = prev
+        self._version[slot] += 1
+        self._free.append(slot)
+        self._count -= 1
+        for neighbour in (prev, nxt):
+            self._version[neighbour] += 1
+            self._pushGap(neighbour)
+
+    def _slots(self, since=None):
+        if since is None:
+            slot = self._head
+            while slot >= 0:
+                yield slot
+                slot = self._next[slot]
+        else:
+            # Newest samples are what incremental readers ask for, so walk back from the tail
+            slots = []
+            slot = self._tail
+            while slot >= 0 and self._time[slot] > since:
+                slots.append(slot)
+                slot = self._prev[slot]
+            yield from reversed(slots)
+
+    def column(self, name, since=None):
+        column = self._columns[name]
+        return [column[slot] for slot in self._slots(since)]
+
+    def columns(self, since=None):
+        """
+        Returns the samples, or only those newer than since, as a dict of column name to list
+        """
+        slots = list(self._slots(since))
+        return {name: [column[slot] for slot in slots] for (name, column) in self._columns.items()}
+
+# (name, bucket length in seconds, number of buckets kept)
+ROLLUP_RESOLUTIONS = (('minute', 60, 2*24*60), ('hour', 3600, 90*24), ('day', 86400, 5*365))
+
+class Rollup:
+    """
+    Min, max and mean of every column over fixed length time buckets, maintained
+    incrementally as samples are added. NaN values are left out of the aggregates.
+    """
+    def __init__(self, columns, resolution, retention):
+        self.resolution = resolution
+        self.retention = retention
+        self.columnNames = list(columns)
+        self.times = array('d')
+        self.mins = {name: array('d') for name in self.columnNames}
+        self.maxs = {name: array('d') for name in self.columnNames}
+        self.means = {name: array('d') for name in self.columnNames}
+        self.bucketStart = None
+        self._reset()
+
+    def _reset(self):
+        self._min = {name: float('inf') for name in self.columnNames}
+        self._max = {name: float('-inf') for name in self.columnNames}
+        self._sum = {name: 0.0 for name in self.columnNames}
+        self._count = {name: 0 for name in self.columnNames}
+
+    def _aggregate(self, name):
+        if self._count[name] == 0:
+            return (float('nan'), float('nan'), float('nan'))
+        return (self._min[name], self._max[name], self._sum[name]/self._count[name])
+
+    def _close(self):
+        self.times.append(self.bucketStart)
+        for name in self.columnNames:
+            (low, high, mean) = self._aggregate(name)
+            self.mins[name].append(low)
+            self.maxs[name].append(high)
+            self.means[name].append(mean)
+        # Trim in batches so that the amortized cost of an append stays O(1)
+        excess = len(self.times) - self.retention
+        if excess >= max(1, self.retention//8):
+            del self.times[:excess]
+            for name in self.columnNames:
+                del self.mins[name][:excess]
+                del self.maxs[name][:excess]
+                del self.means[name][:excess]
+        self._reset()
+
+    def add(self, timestamp, values):
+        start = timestamp - timestamp % self.resolution
+        if self.bucketStart is not None and start != self.bucketStart:
+            self._close()
+        self.bucketStart = start
+        for name in self.columnNames:
+            value = values.get(name, float('nan'))
+            if value != value:
+                continue
+            if value < self._min[name]:
+                self._min[name] = value
+            if value > self._max[name]:
+                self._max[name] = value
+            self._sum[name] += value
+            self._count[name] += 1
+
+    def earliest(self):
+        return self.times[0] if len(self.times) else self.bucketStart
+
+    def range(self, start=None, end=None, since=None):
+        """
+        Returns the buckets overlapping [start, end] and starting after since, the still open
+        bucket included, as a dict with the bucket start as 'timestamp' and, for each
+        column, its mean under the column name and its extremes as <column>Min/<column>Max,
+        all NaN for a bucket without samples of the column
+        """
+        first = 0 if start is None else bisect_right(self.times, start - self.resolution)
+        if since is not None:
+            first = max(first, bisect_right(self.times, since))
+        last = len(self.times) if end is None else bisect_right(self.times, end, first)
+        data = {'timestamp': self.times[first:last].tolist()}
+        for name in self.columnNames:
+            data[name] = self.means[name][first:last].tolist()
+            data[name + 'Min'] = self.mins[name][first:last].tolist()
+            data[name + 'Max'] = self.maxs[name][first:last].tolist()
+        current = self.bucketStart
+        if current is not None and (end is None or current <= end) and (since is None or current > since):
+            data['timestamp'].append(current)
+            for name in self.columnNames:
+                (low, high, mean) = self._aggregate(name)
+                data[name].append(mean)
+                data[name + 'Min'].append(low)
+                data[name + 'Max'].append(high)
+        return data
+
+class Rollups:
+    """
+    Rollups of the same samples at several resolutions
+    """
+    def __init__(self, columns, resolutions=ROLLUP_RESOLUTIONS, timeColumn='timestamp'):
+        self.timeColumn = timeColumn
+        columns = [name for name in columns if name != timeColumn]
+        self.resolutions = {name: Rollup(columns, length, retention) for (name, length, retention) in resolutions}
+        self.byLength = sorted(self.resolutions.values(), key=lambda rollup: rollup.resolution)
+
+    def add(self, values):
+        timestamp = values[self.timeColumn]
+        for rollup in self.byLength:
+            rollup.add(timestamp, values)
+
+    def select(self, start, end, maxPoints):
+        """
+        Picks the rollup to answer a query for [start, end] with: the finest resolution that
+        still reaches back to start and needs at most maxPoints buckets for the span, so that
+        the cost of a query does not grow with the age of the batch. Falls back to the
+        coarsest resolution.
+        """
+        for rollup in self.byLength:
+            earliest = rollup.earliest()
+            if earliest is None or (start is not None and earliest > start):
+                continue
+            span = end - (start if start is not None else earliest)
+            if span/rollup.resolution <= maxPoints:
+                return rollup
+        return self.byLength[-1]
+
+def jsonColumns(columns):
+    """
+    Returns the columns as lists with missing (NaN) values as None, since JSON has no NaN
+    """
+    return {name: [None if value != value else value for value in values] for (name, values) in columns.items()}
+
+BINARY_MAGIC = b'TFH1'
+
+def packColumns(columns, wideColumns=('label', 'timestamp')):
+    """
+    Packs a dict of equally long columns into the compact binary history format
+
+    All values are little-endian. The 12 byte header holds the magic 'TFH1', the number of
+    samples (uint32), the number of columns (uint16) and a reserved uint16. Each column is
+    then described by its item size (uint8, 8 for float64 or 4 for float32), the length
+    of its name (uint8) and its ASCII name. The column data follows in the same order,
+    every block starting on an 8 byte boundary so it can be viewed as a typed array
+    directly. Columns named in wideColumns are float64, the others float32.
+    """
+    names = list(columns)
+    count = len(columns[names[0]]) if names else 0
+    parts = [struct.pack('<4sIHH', BINARY_MAGIC, count, len(names), 0)]
+    for name in names:
+        encoded = name.encode('ascii')
+        parts.append(struct.pack('<BB', 8 if name in wideColumns else 4, len(encoded)) + encoded)
+    for name in names:
+        parts.append(bytes(-sum(map(len, parts)) % 8))
+        values = array('d' if name in wideColumns else 'f', columns[name])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        parts.append(values.tobytes())
+    return b''.join(parts)
+
+if __name__ == '__main__':
+    # Benchmark of the cost of one controller tick (append + eviction) against the
+    # history size, for this store and for the plain lists it replaces
+    import timeit
+    from itertools import count
+
+    def mostredundanttime(ar):
+        mint = float('inf')
+        minpos = -1
+        for i in range(1, len(ar) - 1):
+            delta = ar[i + 1] - ar[i - 1]
+            if delta < mint:
+                mint = delta
+                minpos = i
+        return minpos
+
+    for size in (300, 3000, 30000, 300000):
+        clock = count()
+        history = History(['temperature', 'power', 'setpoint', 'gravity'], size)
+        lists = [list() for i in range(5)]
+        for i in range(size):
+            t = next(clock)
+            history.append({'timestamp': t, 'temperature': 20.0, 'power': 0.0, 'setpoint': 18.0, 'gravity': 1.050})
+            for l in lists:
+                l.append(t)
+
+        def tick():
+            history.append({'timestamp': next(clock), 'temperature': 20.0, 'power': 0.0, 'setpoint': 18.0, 'gravity': 1.050})
+
+        def listTick():
+            t = next(clock)
+            for l in lists:
+                l.append(t)
+            i = mostredundanttime(lists[0])
+            for l in lists:
+                del l[i]
+
+        number = 2000
+        arrayCost = timeit.timeit(tick, number=number)/number
+        number = max(5, min(2000, 3000000//size))
+        listCost = timeit.timeit(listTick, number=number)/number
+        print("size %7d: %8.2f us/tick (lists: %10.2f us/tick)"%(size, arrayCost*1e6, listCost*1e6))
@@ -1,4 +1,7 @@
 import logging
+import time
+
+from event import notify, Event
 
 logger = logging.getLogger(__name__)
 
@@ -12,24 +15,76 @@ class Runnable:
         pass
 
 class Measurable:
+    # The measurement channels published, as (channel, name of the method returning its latest value)
+    channels = (('temperature', 'temp'),)
+
+    def channelReaders(self):
+        return [(channel, getattr(self, method)) for (channel, method) in self.channels]
+
     def getMeasurements(self):
-        pass
+        return {channel: reader() for (channel, reader) in self.channelReaders()}
 
 class Sensor(Component, Runnable, Measurable):
+    # Polled sensors set this to the polling.Poller timing their readings
+    poller = None
 
     async def run(self):
         pass
 
+    def setpointChanged(self, setpoint):
+        """
+        Called by the controller using the sensor with its setpoint
+        """
+        if self.poller is not None:
+            self.poller.setpoint(setpoint)
+
     async def readTemp(self):
         pass
 
+    def temp(self):
+        pass
+
 class Actor(Component, Runnable):
+    """
+    Actors implement writePower to drive their hardware. updatePower skips the write,
+    and the power notification, when the power asked for is the one last written,
+    unless stateRefreshInterval seconds have passed since, so unchanged output is
+    still written out now and then.
+    """
+    power = 0.0
+    stateRefreshInterval = 60.0
+    writes = 0
+    skippedWrites = 0
+    _confirmedPower = None
+    _lastWrite = float('-inf')
+
     def updatePower(self, power):
+        now = time.monotonic()
+        if power == self._confirmedPower and now - self._lastWrite < self.stateRefreshInterval:
+            self.skippedWrites += 1
+            return
+        self.power = power
+        self.writePower(power)
+        self._confirmedPower = power
+        self._lastWrite = now
+        self.writes += 1
+        notify(Event(source=self.name, endpoint='power', data=power))
+
+    def writePower(self, power):
         pass
 
+    def invalidatePower(self):
+        """
+        Forgets the last written power, e.g. after a write failed, so the next update is written
+        """
+        self._confirmedPower = None
+
     def getPower(self):
-        pass
-        
+        return self.power
+
+    def writeStats(self):
+        return {'writes': self.writes, 'skippedWrites': self.skippedWrites}
+
     def on(self):
         pass
 
@@ -1,7 +1,6 @@
 import logging
 
 from interfaces import Actor
-from event import notify, Event
 
 logger = logging.getLogger(__name__)
 
@@ -18,13 +17,8 @@ class DummyActor(Actor):
     def off(self):
         self.updatePower(0.0)
 
-    def updatePower(self, power):
-        self.power = power
-        notify(Event(source=self.name, endpoint='power', data=self.power))
-        logger.debug("%s: Setting power to %f"%(self.name, self.power))
-
-    def getPower(self):
-        return self.power
+    def writePower(self, power):
+        logger.debug("%s: Setting power to %f"%(self.name, power))
 
     def callback(self, endpoint, data):
         if endpoint == 'state':
@@ -5,24 +5,29 @@ import asyncio
 from random import normalvariate
 
 from interfaces import Sensor
+import polling
 
 from event import notify, Event
 
 def factory(name, settings):
-    return DummySensor(name, settings['fakeTemp'])
+    return DummySensor(name, settings['fakeTemp'], polling.fromSettings(settings, 10.0))
 
 class DummySensor(Sensor):
-    def __init__(self, name, fakeTemp):
+    channels = (('temperature', 'temp'), ('gravity', 'gravity'))
+
+    def __init__(self, name, fakeTemp, poller=None):
         self.fakeTemp = fakeTemp
         self.lastTemp = 0
         self.name = name
+        self.poller = poller or polling.Poller(10.0)
         asyncio.get_event_loop().create_task(self.run())
 
 
     async def run(self):
         while True:
             self.lastTemp = await self.readTemp() 
-            await asyncio.sleep(10)
+            self.poller.update(self.lastTemp)
+            await self.poller.wait()
 
     async def readTemp(self):
         await asyncio.sleep(2)
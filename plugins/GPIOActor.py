@@ -1,8 +1,5 @@
 from interfaces import Actor
-from event import notify, Event
-
-import RPi.GPIO as GPIO
-GPIO.setmode(GPIO.BCM)
+from hal import gpio
 
 def factory(name, settings):
     return GPIOActor(name, settings['gpio'], settings.get('pwmFrequency',2))
@@ -14,17 +11,11 @@ class GPIOActor(Actor):
         self.power = 0.0
         self.pin = pin
         self.frequency = pwmFrequency
-        GPIO.setup(self.pin, GPIO.OUT)
-        self.p = GPIO.PWM(self.pin, self.frequency)
+        self.p = gpio.openPWM(self.pin, self.frequency)
         self.p.start(self.power)
 
-    def updatePower(self, power):
-        self.power = power
-        self.p.ChangeDutyCycle(self.power)
-        notify(Event(source=self.name, endpoint='power', data=power))
-
-    def getPower(self):
-        return self.power
+    def writePower(self, power):
+        self.p.changeDutyCycle(power)
 
     def on(self):
         self.updatePower(100.0)
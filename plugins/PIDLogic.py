@@ -16,7 +16,8 @@ def factory(name, settings):
     kp = settings['p']
     ki = settings['i']
     kd = settings['d']
-    logic = PIDLogic(10.0, kp, ki, kd, 0, 100)
+    sampleTime = settings.get('sampleTime', 10.0)
+    logic = PIDLogic(sampleTime, kp, ki, kd, 0, 100)
     return logic
 
 class PIDLogic(Logic):
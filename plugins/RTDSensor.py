@@ -1,85 +1,117 @@
+"""
+PT100/PT1000 sensors read through a MAX31865 RTD converter on SPI
+
+The converter is put in automatic conversion mode once, after which it converts
+continuously (every 20 ms at the 50 Hz filter setting) and a reading is a single
+transfer of the RTD registers. Transfers go through the SPI bus' worker thread
+(see hal.spi), which serializes all converters on a bus.
+"""
 import logging
-import aiofiles
 import asyncio
-import math
-from time import sleep
-import spidev
 from event import notify, Event
+from hal import spi
+import calibration
+import polling
+import rtd
 from interfaces import Sensor
 
 logger = logging.getLogger(__name__)
 
+# Configuration register: bias on, automatic conversion, 3 wire, clear faults, 50 Hz filter
+CONFIG_AUTO = 0xD3
+REG_CONFIG = 0x00
+REG_RTD = 0x01
+REG_FAULT = 0x07
+WRITE = 0x80
+# Bias voltage settling plus the first conversion after enabling automatic conversion
+SETTLE_TIME = 0.1
+
 def factory(name, settings):
     device = settings.get('device', 0)
     bus = settings.get('bus', 0)
-    offset = settings.get('offset', 0.0)
-    pollInterval = settings.get('pollInterval', 2.0)
     rref = settings.get('referenceResistance', 430)
     r0 = settings.get('zeroDegResistance', 100)
-    return RTDSensor(name, bus, device, rref, r0, offset, pollInterval)
+    return RTDSensor(name, bus, device, rref, r0, calibration.fromSettings(settings), polling.fromSettings(settings, 2.0))
 
 class RTDSensor(Sensor):
-    def __init__(self, name, bus=0, device=0, rref=430, r0=100, offset=0, pollInterval=0):
+    def __init__(self, name, bus=0, device=0, rref=430, r0=100, curve=None, poller=None):
         self.name = name
-        self.offset = offset
+        self.calibration = curve or calibration.Calibration()
         self.lastTemp = 0.0
-        self.pollInterval = pollInterval
+        self.poller = poller or polling.Poller(2.0)
         self.device = device
         self.bus = bus
         self.rref = rref
         self.r0 = r0
-        self.spi = spidev.SpiDev()
-        self.spi.open(self.bus, self.device)
-        self.spi.mode = 0b01
-        self.spi.max_speed_hz = 500000
+        self.table = rtd.getTable(rref, r0)
+        self.spi = spi.openDevice(self.bus, self.device, mode=0b01, speedHz=500000,
+                                  model='max31865', rref=self.rref, r0=self.r0)
 
         asyncio.get_event_loop().create_task(self.run())
 
+    async def configure(self):
+        await self.spi.transfer([WRITE | REG_CONFIG, CONFIG_AUTO])
+        await asyncio.sleep(SETTLE_TIME)
 
     async def run(self):
+        await self.configure()
         while True:
             try:
-                self.lastTemp = await asyncio.get_event_loop().run_in_executor(None, self.readTemp) + self.offset
+                self.lastTemp = self.calibration.apply(await self.readTemp())
                 notify(Event(source=self.name, endpoint='temperature', data=self.lastTemp))
             except RuntimeError as e:
                 logger.debug(str(e))
-            await asyncio.sleep(self.pollInterval)
+            self.poller.update(self.lastTemp)
+            await self.poller.wait()
 
-    def readTemp(self):
-        self.spi.xfer([0x80, 0xB3])
-        self.spi.xfer([0x00])
-        sleep(0.1)
-        data = self.spi.xfer([0,0,0,0,0,0,0,0,0])
-        adc_res = (( data[2] << 8 ) | data[3] ) >> 1
-        return self.calcTemp(adc_res)
+    async def readTemp(self):
+        data = await self.spi.transfer([REG_RTD, 0, 0])
+        rtd = (data[1] << 8) | data[2]
+        if rtd & 1:
+            fault = (await self.spi.transfer([REG_FAULT, 0]))[1]
+            # Writing the configuration again clears the fault
+            await self.spi.transfer([WRITE | REG_CONFIG, CONFIG_AUTO])
+            raise RuntimeError("MAX31865 %d.%d fault 0x%02x"%(self.bus, self.device, fault))
+        return self.calcTemp(rtd >> 1)
 
     def calcTemp(self, adc_res):
-            a = 3.9083e-3
-            b = -5.7750e-7
-            rt = (adc_res*self.rref) / 32768.0 # Resistance of RTD 
-            temp_C = -a*self.r0 + math.sqrt(self.r0**2*a**2 - 4*self.r0*b*(self.r0-rt))
-            temp_C /= 2*self.r0*b
-            if (temp_C < 0): 
-                temp_C = (adc_res/32) - 256
-            return temp_C
+        return self.table.temperature(adc_res)
 
     def temp(self):
         return self.lastTemp
 
 if __name__ == '__main__':
+    # Compares the read latency of four converters on one simulated bus, read
+    # concurrently, with the one-shot conversion previously done on every read
+    import time
+    import hal
+    from time import sleep
 
-    def blip():
-        asyncio.get_event_loop().call_later(0.1, blip)
-
+    hal.configure(hal.SIMULATED)
     loop = asyncio.get_event_loop()
-    settings = {}
-    sensor = factory("RTDSensor", settings)
-    loop.call_soon(blip)
+    sensors = [RTDSensor('RTD%d'%i, 0, i) for i in range(4)]
+
+    def readOneShot(sensor):
+        sensor.spi.xfer([0x80, 0xB3])
+        sensor.spi.xfer([0x00])
+        sleep(0.1)
+        data = sensor.spi.xfer([0,0,0,0,0,0,0,0,0])
+        return sensor.calcTemp((( data[2] << 8 ) | data[3] ) >> 1)
+
+    async def timed(read):
+        started = time.monotonic()
+        await read
+        return time.monotonic() - started
 
-    temp = sensor.readTemp()
+    async def benchmark(rounds=10):
+        await asyncio.sleep(2*SETTLE_TIME)
+        # Automatic first, as a one-shot read turns automatic conversion off
+        for (label, read) in (('automatic', lambda sensor: sensor.readTemp()),
+                              ('one-shot', lambda sensor: loop.run_in_executor(None, readOneShot, sensor))):
+            latencies = []
+            for i in range(rounds):
+                latencies.extend(await asyncio.gather(*[timed(read(sensor)) for sensor in sensors]))
+            print("%-9s mean read latency %.1f ms, max %.1f ms"%(label, 1000*sum(latencies)/len(latencies), 1000*max(latencies)))
 
-    try:
-        loop.run_forever()
-    finally:
-        loop.close()
+    loop.run_until_complete(benchmark())
 
@@ -2,11 +2,12 @@
 Implements using a TPLink socket as an actor
 """
 import asyncio
+import json
 import logging
-
-from aiohttp import web
+import struct
 
 from interfaces import Actor
+import timeprop
 from event import notify, Event
 
 logger = logging.getLogger(__name__)
@@ -16,40 +17,153 @@ def factory(name, settings):
 
 # Encryption and Decryption of TP-Link Smart Home Protocol
 # XOR Autokey Cipher with starting key = 171
-def encrypt(string):
-    key = 171
-    result = b'\0\0\0\0'
-    for i in string:
-        a = key ^ i
-        key = a
-        result += bytes([a])
-    return result
+# Over TCP every message is preceded by its length as a 4 byte big-endian integer
+HEADER = struct.Struct('>I')
+
+KEY = b'\xab'
+
+# Both directions work on the whole message as one big integer instead of byte by byte.
+# A ciphertext byte is the XOR of the key and all plaintext bytes up to it, a prefix XOR
+# that takes log2(n) shift-and-XOR steps, and a plaintext byte is the XOR of its
+# ciphertext byte and the one before it.
+def encrypt(string, header=True):
+    size = len(string) + 1
+    value = int.from_bytes(KEY + string, 'big')
+    shift = 8
+    while shift < 8*size:
+        value ^= value >> shift
+        shift *= 2
+    encrypted = memoryview(value.to_bytes(size, 'big'))[1:]
+    if header:
+        return HEADER.pack(len(string)) + encrypted
+    return encrypted.tobytes()
 
 def decrypt(string):
-    key = 171
-    result = b''
-    for i in string:
-        a = key ^ i
-        key = i
-        result += bytes(chr(a), 'ascii')
-    return result
+    string = memoryview(string)
+    if not string:
+        return b''
+    previous = int.from_bytes(KEY + string[:-1], 'big')
+    return (int.from_bytes(string, 'big') ^ previous).to_bytes(len(string), 'big')
+
+class TPLinkConnection:
+    """
+    Long-lived connection to one plug, reconnecting when the plug drops it.
+    Requests are sent one at a time and their responses read back.
+    """
+    def __init__(self, host, port=9999, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+        self.connects = 0
+
+    async def _connect(self):
+        (self.reader, self.writer) = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        self.connects += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
 
+    async def _roundTrip(self, data):
+        if self.writer is None:
+            await self._connect()
+        self.writer.write(data)
+        (length,) = HEADER.unpack(await asyncio.wait_for(self.reader.readexactly(HEADER.size), self.timeout))
+        return decrypt(await asyncio.wait_for(self.reader.readexactly(length), self.timeout))
 
-class TPLinkProtocol(asyncio.Protocol):
-    def __init__(self):
+    async def request(self, msg):
+        """
+        Sends msg (a JSON string) and returns the decoded JSON response
+        """
+        data = encrypt(msg.encode('ascii'))
+        async with self.lock:
+            try:
+                response = await self._roundTrip(data)
+            except (OSError, EOFError, asyncio.TimeoutError):
+                # The plug may have closed an idle connection, retry once on a fresh one
+                self.close()
+                try:
+                    response = await self._roundTrip(data)
+                except (OSError, EOFError, asyncio.TimeoutError):
+                    self.close()
+                    raise
+        return json.loads(response.decode('utf-8'))
+
+connections = {}
+
+def getConnection(host, port=9999):
+    if (host, port) not in connections:
+        connections[(host, port)] = TPLinkConnection(host, port)
+    return connections[(host, port)]
+
+class FakePlug:
+    """
+    Local stand-in for a plug, answering set_relay_state and get_sysinfo, for trying
+    out and benchmarking the protocol without hardware
+    """
+    def __init__(self, alias='Fake plug', mac='50:C7:BF:00:00:01'):
+        self.relayState = 0
+        self.alias = alias
+        self.mac = mac
+        self.requests = 0
+        self.server = None
         self.transport = None
 
+    def sysinfo(self):
+        return {'alias': self.alias, 'mac': self.mac, 'relay_state': self.relayState,
+                'model': 'HS110(EU)', 'dev_name': 'Smart Wi-Fi Plug', 'on_time': 0, 'err_code': 0}
+
+    def handle(self, request):
+        self.requests += 1
+        system = request.get('system', {})
+        response = {}
+        if 'set_relay_state' in system:
+            self.relayState = system['set_relay_state']['state']
+            response['set_relay_state'] = {'err_code': 0}
+        if 'get_sysinfo' in system:
+            response['get_sysinfo'] = self.sysinfo()
+        response = {'system': response}
+        if 'emeter' in request:
+            response['emeter'] = {'get_realtime': {'power_mw': 1500*self.relayState, 'voltage_mv': 230000, 'err_code': 0}}
+        return response
+
+    def datagram_received(self, data, address):
+        request = json.loads(decrypt(data).decode('utf-8'))
+        self.transport.sendto(encrypt(json.dumps(self.handle(request)).encode('ascii'), header=False), address)
+
     def connection_made(self, transport):
         self.transport = transport
-        #print("connected")
+
+    def error_received(self, exc):
+        pass
 
     def connection_lost(self, exc):
-        if exc:
-            logger.error(exc)
+        pass
 
-    def data_received(self, data):
-        msg = decrypt(data[4:])
-        #print(msg.decode('ascii'))
+    async def serve(self, reader, writer):
+        try:
+            while True:
+                (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+                request = json.loads(decrypt(await reader.readexactly(length)).decode('utf-8'))
+                writer.write(encrypt(json.dumps(self.handle(request)).encode('ascii')))
+        except (EOFError, ConnectionError):
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=0, discovery=False):
+        """
+        Listens for TCP requests on host:port, and for UDP discovery on the same port
+        if discovery is set. Returns the port.
+        """
+        self.server = await asyncio.start_server(self.serve, host, port)
+        port = self.server.sockets[0].getsockname()[1]
+        if discovery:
+            await asyncio.get_event_loop().create_datagram_endpoint(lambda: self, local_addr=(host, port))
+        return port
 
 class TPLinkActor(Actor):
     onMsg = '{"system":{"set_relay_state":{"state":1}}}'
@@ -61,52 +175,58 @@ class TPLinkActor(Actor):
         self.name = name
         self.power = 0
         self.loop = asyncio.get_event_loop()
-        self.protocol = TPLinkProtocol()
         self.settings = settings
-        asyncio.ensure_future(self.schedule())
-
-    async def schedule(self):
-        while True:
-            if self.power == 100.0:
-                await self.send(self.onMsg)
-                await asyncio.sleep(self.refreshInterval)
-            elif self.power == 0.0:
-                await self.send(self.offMsg)
-                await asyncio.sleep(self.refreshInterval)
-            else:
-                onTime = self.refreshInterval*self.power/100.0
-                offTime = self.refreshInterval - onTime
-                await self.send(self.onMsg)
-                await asyncio.sleep(onTime)
-                await self.send(self.offMsg)
-                await asyncio.sleep(offTime)
+        self.alias = settings.get('alias')
+        self.connection = None
+        self.relayState = None
+        if 'ip' in settings:
+            self.setHost(settings['ip'], settings.get('port', 9999))
+        self.output = timeprop.engine.register(name, self.switch, settings.get('cycleTime', self.refreshInterval),
+                                               settings.get('minOn', 0.0), settings.get('minOff', 0.0),
+                                               settings.get('phase'), settings.get('circuit'))
 
+    def switch(self, on):
+        asyncio.ensure_future(self.send(self.onMsg if on else self.offMsg))
 
-    def updatePower(self, power):
-        self.power = power
-        notify(Event(source=self.name, endpoint='power', data=power))
+    def writePower(self, power):
+        self.output.setDuty(power/100.0)
 
-    def getPower(self):
-        return self.power
+    def setHost(self, host, port=9999):
+        self.connection = getConnection(host, port)
+
+    def updateStatus(self, status):
+        """
+        Takes in a get_sysinfo (and optionally emeter get_realtime) response polled from the plug
+        """
+        sysinfo = status.get('system', {}).get('get_sysinfo', {})
+        if 'relay_state' in sysinfo:
+            self.relayState = sysinfo['relay_state']
+            notify(Event(source=self.name, endpoint='relay', data=self.relayState))
+        realtime = status.get('emeter', {}).get('get_realtime', {})
+        if realtime.get('err_code', -1) == 0:
+            # Older firmware reports W, newer mW
+            power = realtime['power'] if 'power' in realtime else realtime.get('power_mw', 0)/1000.0
+            notify(Event(source=self.name, endpoint='consumption', data=power))
 
     async def isRelayOn(self):
             await self.send(self.infoMsg)
 
     async def send(self, msg):
+        if self.connection is None:
+            logger.debug("TPLinkActor %s: plug %s not discovered yet", self.name, self.alias)
+            return
         try:
-            (transport, protocol) = await self.loop.create_connection(lambda: self.protocol, self.settings['ip'], 9999)
-            transport.write(encrypt(bytes(msg,'ascii')))
-        except OSError as e:
+            return await self.connection.request(msg)
+        except (OSError, EOFError, asyncio.TimeoutError, ValueError) as e:
             logger.warning("TPLinkActor %s: %s"%(self.name, str(e)))
+            self.invalidatePower()
 
     def on(self):
         print("Turning %s on"%self.name)
-        asyncio.ensure_future(self.send(self.onMsg))
         self.updatePower(100.0)
 
     def off(self):
         print("Turning %s off"%self.name)
-        asyncio.ensure_future(self.send(self.offMsg))
         self.updatePower(0.0)
 
     def callback(self, endpoint, data):
@@ -117,30 +237,41 @@ class TPLinkActor(Actor):
                 self.on()
             else:
                 logger.warning("TPLinkActor:%s unsupported data value for state endpoint: %d"%(self.name, data))
+        elif endpoint == 'status':
+            self.updateStatus(data)
         elif endpoint == 'power':
-            if data == 100.0:
-                self.on()
-            elif data == 0.0:
-                self.off()
-            else:
-                self.updatePower(data)
+            self.updatePower(data)
         else:
             logger.warning("TPLinkActor: %s unsupported endpoint %s"%(self.name, endpoint))
 
 if __name__ == '__main__':
+    # Benchmarks request throughput and latency against a local fake plug, for a
+    # persistent connection and for a new connection per message as before
+    import time
 
-    def blip():
-        asyncio.get_event_loop().call_later(0.1, blip)
-
-    loop = asyncio.get_event_loop()
-    settings = {'ip': '192.168.8.116'}
-    actor = factory("TPLinkActor", settings)
-    loop.call_soon(blip)
+    async def benchmark(count=2000):
+        plug = FakePlug()
+        port = await plug.start()
+        for persistent in (False, True):
+            latencies = []
+            started = time.perf_counter()
+            for i in range(count):
+                connection = getConnection('127.0.0.1', port) if persistent else TPLinkConnection('127.0.0.1', port)
+                sent = time.perf_counter()
+                await connection.request(TPLinkActor.onMsg if i % 2 else TPLinkActor.offMsg)
+                latencies.append(time.perf_counter() - sent)
+                if not persistent:
+                    connection.close()
+            elapsed = time.perf_counter() - started
+            latencies.sort()
+            print("%-10s %7.0f requests/s, latency median %.3f ms, 99%% %.3f ms"%(
+                'persistent' if persistent else 'per message', count/elapsed,
+                1000*latencies[count//2], 1000*latencies[int(count*0.99)]))
 
-    actor.updatePower(15.0)
-    #actor.off()
+        message = TPLinkActor.infoMsg.encode('ascii')*20
+        started = time.perf_counter()
+        for i in range(2000):
+            decrypt(encrypt(message)[4:])
+        print("codec %.1f MB/s"%(2000*len(message)/(time.perf_counter() - started)/1e6))
 
-    try:
-        loop.run_forever()
-    finally:
-        loop.close()
+    asyncio.get_event_loop().run_until_complete(benchmark())
@@ -0,0 +1,145 @@
+"""
+Discovers TP-Link plugs on the network and keeps their status up to date
+
+Plugs are discovered by broadcasting a get_sysinfo request on UDP port 9999 and
+collecting the answers. All discovered plugs, and the plugs of actors configured by
+ip, are then polled concurrently over their pooled TCP connections, with at most
+maxInFlight requests outstanding, and every answer is handed to the TPLinkActor
+configured for that plug (by ip or by alias) as a 'status' event. Actors configured
+by alias get the plug's address once it is found, and again when it changes.
+"""
+import asyncio
+import json
+import logging
+import socket
+
+from interfaces import Component, Runnable
+from common import components
+from plugins.TPLinkActor import TPLinkActor, encrypt, decrypt, getConnection
+
+logger = logging.getLogger(__name__)
+
+STATUS_MSG = '{"system":{"get_sysinfo":{}},"emeter":{"get_realtime":{}}}'
+
+def factory(name, settings):
+    broadcast = settings.get('broadcast', '255.255.255.255')
+    if isinstance(broadcast, str):
+        broadcast = [broadcast]
+    return TPLinkFleet(name, broadcast, settings.get('port', 9999), settings.get('pollInterval', 30),
+                       settings.get('discoveryInterval', 300), settings.get('maxInFlight', 8))
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, fleet):
+        self.fleet = fleet
+
+    def datagram_received(self, data, address):
+        try:
+            response = json.loads(decrypt(data).decode('utf-8'))
+        except ValueError as e:
+            logger.debug("Ignoring malformed discovery answer from %s: %s", address[0], e)
+            return
+        self.fleet.found(address[0], response)
+
+    def error_received(self, exc):
+        logger.debug("Discovery error: %s", exc)
+
+class TPLinkFleet(Component, Runnable):
+    def __init__(self, name, broadcast, port=9999, pollInterval=30, discoveryInterval=300, maxInFlight=8):
+        self.name = name
+        self.broadcast = broadcast
+        self.port = port
+        self.pollInterval = pollInterval
+        self.discoveryInterval = discoveryInterval
+        self.semaphore = asyncio.Semaphore(maxInFlight)
+        # ip -> latest get_sysinfo answer
+        self.plugs = {}
+        self.polls = 0
+        self.failures = 0
+        asyncio.ensure_future(self.run())
+
+    def actors(self):
+        return [component for component in components.values() if isinstance(component, TPLinkActor)]
+
+    def found(self, ip, response):
+        sysinfo = response.get('system', {}).get('get_sysinfo', {})
+        if ip not in self.plugs:
+            logger.info("Found TP-Link plug %s at %s", sysinfo.get('alias'), ip)
+        # A plug that got a new address (e.g. from DHCP) is no longer at the old one
+        mac = sysinfo.get('mac')
+        for (otherIp, other) in list(self.plugs.items()):
+            if otherIp != ip and mac is not None and other.get('mac') == mac:
+                del self.plugs[otherIp]
+        self.plugs[ip] = sysinfo
+        for actor in self.actors():
+            if actor.alias is not None and actor.alias == sysinfo.get('alias'):
+                if actor.connection is None or actor.connection.host != ip:
+                    if actor.connection is not None:
+                        logger.info("TP-Link plug %s moved from %s to %s", actor.alias, actor.connection.host, ip)
+                    actor.setHost(ip, self.port)
+
+    async def discover(self, timeout=2.0):
+        loop = asyncio.get_event_loop()
+        (transport, protocol) = await loop.create_datagram_endpoint(lambda: DiscoveryProtocol(self), family=socket.AF_INET,
+                                                                    allow_broadcast=True)
+        try:
+            request = encrypt(b'{"system":{"get_sysinfo":{}}}', header=False)
+            for address in self.broadcast:
+                transport.sendto(request, (address, self.port))
+            await asyncio.sleep(timeout)
+        finally:
+            transport.close()
+
+    async def pollOne(self, connection):
+        async with self.semaphore:
+            try:
+                status = await connection.request(STATUS_MSG)
+            except (OSError, EOFError, asyncio.TimeoutError, ValueError) as e:
+                self.failures += 1
+                logger.warning("Polling %s failed: %s", connection.host, e)
+                return
+        self.polls += 1
+        sysinfo = status.get('system', {}).get('get_sysinfo')
+        if sysinfo is not None and connection.host in self.plugs:
+            self.plugs[connection.host] = sysinfo
+        for actor in self.actors():
+            if actor.connection is connection:
+                actor.callback('status', status)
+
+    async def poll(self):
+        connections = {(ip, self.port): getConnection(ip, self.port) for ip in self.plugs}
+        for actor in self.actors():
+            if actor.connection is not None:
+                connections[(actor.connection.host, actor.connection.port)] = actor.connection
+        await asyncio.gather(*[self.pollOne(connection) for connection in connections.values()])
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        nextDiscovery = loop.time()
+        while True:
+            if loop.time() >= nextDiscovery:
+                await self.discover()
+                nextDiscovery = loop.time() + self.discoveryInterval
+            await self.poll()
+            await asyncio.sleep(self.pollInterval)
+
+if __name__ == '__main__':
+    # Discovers and polls a set of fake plugs listening on loopback addresses
+    # (run as python -m plugins.TPLinkFleet)
+    import time
+    from plugins.TPLinkActor import FakePlug
+
+    async def demo(count=20):
+        plugs = [FakePlug(alias='Plug %d'%i, mac='50:C7:BF:00:00:%02X'%i) for i in range(count)]
+        port = await plugs[0].start('127.0.0.1', discovery=True)
+        for (i, plug) in enumerate(plugs[1:], 2):
+            await plug.start('127.0.0.%d'%i, port, discovery=True)
+        for (i, plug) in enumerate(plugs):
+            components['Actor%d'%i] = TPLinkActor('Actor%d'%i, {'alias': plug.alias})
+        fleet = TPLinkFleet('fleet', ['127.0.0.%d'%i for i in range(1, count + 1)], port, pollInterval=3600)
+        await fleet.discover(0.5)
+        started = time.perf_counter()
+        await fleet.poll()
+        print("discovered %d plugs, polled %d in %.1f ms, %d failures"%(
+              len(fleet.plugs), fleet.polls, 1000*(time.perf_counter() - started), fleet.failures))
+
+    asyncio.get_event_loop().run_until_complete(demo())
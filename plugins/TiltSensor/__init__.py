@@ -1,20 +1,34 @@
+"""
+Tilt hydrometers
+
+Tilts advertise their readings as iBeacons, the colour of the Tilt encoded in the
+beacon UUID. Every HCI device is scanned by one TiltScanner, however many Tilts and
+TiltSensors there are, which reads the non-blocking HCI socket from the event loop
+whenever it is readable. It keeps the latest reading of every Tilt it hears and
+hands each reading to the sensors configured for that colour (a sensor without a
+colour takes the readings of any Tilt). Tilts advertise about once a second, so a
+sensor publishes a reading at most every minInterval seconds.
+"""
 import asyncio
-import sys
-import datetime
+import errno
 import time
 import logging
 
-import bluetooth._bluetooth as bluez
-
 import TiltSensor.blescan as blescan
+from hal import hci
 
 import interfaces
 from event import notify, Event
 
 logger = logging.getLogger(__name__)
 
+# Seconds between the readings a TiltSensor publishes
+MIN_INTERVAL = 5.0
+# Packets read per wakeup at most, so a flood of advertisements cannot hog the loop
+MAX_BATCH = 64
+
 def factory(name, settings):
-   return TiltSensor(name)
+   return TiltSensor(name, settings.get('colour'), settings.get('device', 0), settings.get('minInterval', MIN_INTERVAL))
 
 
 TILTS = {
@@ -29,15 +43,9 @@ TILTS = {
 }
 
 
-def distinct(objects):
-    seen = set()
-    unique = []
-    for obj in objects:
-        if obj['uuid'] not in seen:
-            unique.append(obj)
-            seen.add(obj['uuid'])
-    return unique
-
+# Every Tilt UUID starts with these bytes, so other beacons are skipped while parsing
+TILT_UUID_PREFIX = bytes.fromhex('a495bb')
+TILT_COLOURS = {bytes.fromhex(uuid): colour for (uuid, colour) in TILTS.items()}
 
 def to_celsius(fahrenheit):
     return round((fahrenheit - 32.0) / 1.8, 2)
@@ -46,47 +54,90 @@ def to_brix(sg):
     brix = (((182.4601*sg  -775.6821)*sg + 1262.7794)*sg - 669.5622)
     return brix
 
+class TiltScanner:
+    def __init__(self, devId):
+        self.devId = devId
+        self.loop = asyncio.get_event_loop()
+        self.sensors = {}
+        self.latest = {}
+        self.sock = None
+        self.packets = 0
+        self.advertisements = 0
+
+    def add(self, sensor):
+        if sensor.colour is not None and sensor.colour not in TILTS.values():
+            raise ValueError('Unknown Tilt colour %s, expected one of %s'%(sensor.colour, ', '.join(sorted(TILTS.values()))))
+        self.sensors.setdefault(sensor.colour, []).append(sensor)
+        if self.sock is None:
+            self.start()
+
+    def start(self):
+        try:
+            self.sock = hci.openDevice(self.devId)
+            logger.info('Starting pytilt logger on hci%d', self.devId)
+            self.sock.enableScan()
+            self.sock.setblocking(False)
+        except Exception:
+            logger.exception('error accessing bluetooth device hci%d...', self.devId)
+            return
+        self.loop.add_reader(self.sock.fileno(), self.readable)
+
+    def readable(self):
+        for i in range(MAX_BATCH):
+            try:
+                pkt = self.sock.recv(255)
+            except OSError as e:
+                # pybluez raises its own error, not BlockingIOError, once drained
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                logger.warning('Reading hci%d failed: %s', self.devId, str(e))
+                return
+            self.packets += 1
+            for (uuid, major, minor, rssi) in blescan.parse_ibeacons(pkt, TILT_UUID_PREFIX):
+                colour = TILT_COLOURS.get(uuid)
+                if colour is not None:
+                    self.advertisements += 1
+                    self.dispatch(colour, to_celsius(major), minor/1000.0)
+
+    def dispatch(self, colour, temp, gravity):
+        now = time.monotonic()
+        self.latest[colour] = (temp, gravity, time.time())
+        for sensor in self.sensors.get(colour, []) + self.sensors.get(None, []):
+            if now - sensor.lastUpdate >= sensor.minInterval:
+                sensor.lastUpdate = now
+                sensor.update(temp, gravity)
+
+scanners = {}
+
+def getScanner(devId):
+    if devId not in scanners:
+        scanners[devId] = TiltScanner(devId)
+    return scanners[devId]
+
 class TiltSensor(interfaces.Sensor):
-    def __init__(self, name):
+    channels = (('temperature', 'temp'), ('gravity', 'gravity'), ('brix', 'brix'))
+
+    def __init__(self, name, colour=None, devId=0, minInterval=MIN_INTERVAL):
        self.name = name
-       self.dev_id = 0
+       self.colour = colour
+       self.minInterval = minInterval
+       self.lastUpdate = float('-inf')
        self.lastTemp = 0.0
        self.lastGravity = 1.0
-       try:
-           self.sock = bluez.hci_open_dev(self.dev_id)
-           logger.info('Starting pytilt logger')
-           blescan.hci_le_set_scan_parameters(self.sock)
-           blescan.hci_enable_le_scan(self.sock)
-       except:
-           logger.error('error accessing bluetooth device...')
-
-       asyncio.get_event_loop().create_task(self.run())
-
-    async def run(self):
-        while True:
-            (temp, gravity) = await asyncio.get_event_loop().run_in_executor(None, self.monitor_tilt)
-            self.lastTemp = temp
-            self.lastGravity = gravity/1000.0
-            notify(Event(source=self.name, endpoint='temperature', data=temp))
-            notify(Event(source=self.name, endpoint='gravity', data=gravity/1000.0))
-            notify(Event(source=self.name, endpoint='brix', data=to_brix(gravity/1000.0)))
-
-    def monitor_tilt(self):
-        while True:
-            beacons = distinct(blescan.parse_events(self.sock, 10))
-            for beacon in beacons:
-                if beacon['uuid'] in TILTS.keys():
-#                     print({
-#                         'color': TILTS[beacon['uuid']],
-#                         'timestamp': datetime.datetime.now().isoformat(),
-#                         'temp': to_celsius(beacon['major']),
-#                         'gravity': beacon['minor']
-#                     })
-                    return (to_celsius(beacon['major']), beacon['minor'])
-#           logger.debug("Nothing found from bluetooth")
-    
+       getScanner(devId).add(self)
+
+    def update(self, temp, gravity):
+        self.lastTemp = temp
+        self.lastGravity = gravity
+        notify(Event(source=self.name, endpoint='temperature', data=temp))
+        notify(Event(source=self.name, endpoint='gravity', data=gravity))
+        notify(Event(source=self.name, endpoint='brix', data=to_brix(gravity)))
+
     def temp(self):
        return self.lastTemp
 
     def gravity (self):
        return self.lastGravity
+
+    def brix(self):
+       return to_brix(self.lastGravity)
@@ -1,30 +1,165 @@
+"""
+Relays on USB HID relay boards, switched without blocking the event loop
+
+Relays are named like the usbrelay tool names them, <board serial>_<relay number>.
+Changes to relays on the same board made within one pass of the event loop, or while
+a write to the board is in flight, are written together as the next transaction:
+with the usbrelay tool in a single invocation, run as an asyncio subprocess, or, when
+the board's hidraw device is configured, as HID feature reports written from a
+worker thread that keeps the device open.
+
+With a cycleTime configured, the relay is time-proportioned (see timeprop) so that a
+power of 35% keeps it on for 35% of every cycle, otherwise any power turns it on.
+"""
+import asyncio
+import fcntl
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from interfaces import Actor
-from event import notify, Event
-from subprocess import call
+import timeprop
+
+logger = logging.getLogger(__name__)
 
 def factory(name, settings):
-    return USBRelayActor(name, settings['id'], settings.get('inverted', False))
+    actor = USBRelayActor(name, settings['id'], settings.get('inverted', False), settings.get('device'))
+    if 'cycleTime' in settings:
+        actor.timeProportion(settings['cycleTime'], settings.get('minOn', 0.0), settings.get('minOff', 0.0),
+                             settings.get('phase'), settings.get('circuit'))
+    return actor
+
+# HIDIOCSFEATURE(9): _IOC(_IOC_READ|_IOC_WRITE, 'H', 0x06, 9)
+HIDIOCSFEATURE_9 = (3 << 30) | (9 << 16) | (ord('H') << 8) | 0x06
+RELAY_ON = 0xFF
+RELAY_OFF = 0xFD
+
+class CommandBackend:
+    """
+    Switches relays by running the usbrelay tool as an asyncio subprocess
+    """
+    def __init__(self, serial):
+        self.serial = serial
+
+    async def write(self, states):
+        args = ['%s_%d=%d'%(self.serial, relay, state) for (relay, state) in sorted(states.items())]
+        process = await asyncio.create_subprocess_exec('usbrelay', *args,
+                                                       stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        returncode = await process.wait()
+        if returncode != 0:
+            raise OSError('usbrelay %s exited with %d'%(' '.join(args), returncode))
+
+class HidrawBackend:
+    """
+    Switches relays by writing feature reports to the board's hidraw device,
+    from a single worker thread that serializes all access to the board
+    """
+    def __init__(self, device):
+        self.device = device
+        self.fd = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def _write(self, states):
+        if self.fd is None:
+            self.fd = os.open(self.device, os.O_RDWR)
+        try:
+            for (relay, state) in sorted(states.items()):
+                report = bytearray([0, RELAY_ON if state else RELAY_OFF, relay, 0, 0, 0, 0, 0, 0])
+                fcntl.ioctl(self.fd, HIDIOCSFEATURE_9, report)
+        except OSError:
+            os.close(self.fd)
+            self.fd = None
+            raise
+
+    async def write(self, states):
+        await asyncio.get_event_loop().run_in_executor(self.executor, self._write, states)
+
+class RelayBoard:
+    def __init__(self, serial, device=None):
+        self.serial = serial
+        self.backend = HidrawBackend(device) if device else CommandBackend(serial)
+        self.pending = {}
+        self.actors = {}
+        self._writing = False
+        self.batches = 0
+        self.relayWrites = 0
+        self.writeTimeMax = 0.0
+        self.writeTimeSum = 0.0
+
+    def set(self, relay, state, actor=None):
+        self.pending[relay] = state
+        if actor is not None:
+            self.actors[relay] = actor
+        if not self._writing:
+            self._writing = True
+            asyncio.get_event_loop().call_soon(self._flush)
 
+    def _flush(self):
+        asyncio.ensure_future(self.drain())
+
+    async def drain(self):
+        # The only writer of the board: whatever is set while a write is in flight
+        # is collected in pending and written as the next single transaction
+        try:
+            while self.pending:
+                states = self.pending
+                self.pending = {}
+                await self.write(states)
+        finally:
+            self._writing = False
+
+    async def write(self, states):
+        started = time.monotonic()
+        try:
+            await self.backend.write(states)
+        except OSError as e:
+            logger.warning("Failed to switch relays %s on board %s: %s"%(states, self.serial, str(e)))
+            for relay in states:
+                if relay in self.actors:
+                    self.actors[relay].invalidatePower()
+            return
+        elapsed = time.monotonic() - started
+        self.batches += 1
+        self.relayWrites += len(states)
+        self.writeTimeSum += elapsed
+        self.writeTimeMax = max(self.writeTimeMax, elapsed)
+        logger.debug("Board %s: wrote %s in %.1f ms", self.serial, states, 1000*elapsed)
+
+boards = {}
+
+def getBoard(serial, device=None):
+    if serial not in boards:
+        boards[serial] = RelayBoard(serial, device)
+    return boards[serial]
 
 class USBRelayActor(Actor):
-    def __init__(self, name, relayName, inverted):
+    def __init__(self, name, relayName, inverted, device=None):
         self.name = name
         self.power = 0.0
         self.relayName = relayName
         self.inverted = bool(inverted)
+        (serial, relay) = relayName.rsplit('_', 1)
+        self.relay = int(relay)
+        self.board = getBoard(serial, device)
+        self.output = None
         self.off()
 
-    def updatePower(self, power):
-        self.power = power
-        print("Sending power %d to %s"%(power, self.name))
-        if (self.power and not self.inverted) or (not self.power and self.inverted):
-            call (["usbrelay", self.relayName + '=1'])
-        else:
-            call (["usbrelay", self.relayName + '=0'])
-        notify(Event(source=self.name, endpoint='power', data=power))
+    def timeProportion(self, cycleTime, minOn=0.0, minOff=0.0, phase=None, circuit=None):
+        """
+        Switches the relay on for power% of every cycle instead of fully on for any power
+        """
+        self.output = timeprop.engine.register(self.name, self.switch, cycleTime, minOn, minOff, phase, circuit)
+
+    def switch(self, on):
+        self.board.set(self.relay, 1 if on != self.inverted else 0, self)
 
-    def getPower(self):
-        return self.power
+    def writePower(self, power):
+        logger.debug("Sending power %d to %s", power, self.name)
+        if self.output is not None:
+            self.output.setDuty(power/100.0)
+        else:
+            self.switch(bool(power))
 
     def on(self):
         self.updatePower(100.0)
@@ -42,3 +177,34 @@ class USBRelayActor(Actor):
                 self.on()
             else:
                 print("Warning: USBRelayActor:%s unsupported data value: %d"%(self.name, data))
+
+if __name__ == '__main__':
+    # Compares how long the event loop is blocked when switching two relays of a
+    # board with the previous synchronous subprocess.call path and with this driver.
+    # Needs the usbrelay tool and a board; pass the board serial as argument.
+    import sys
+    from subprocess import call
+
+    serial = sys.argv[1] if len(sys.argv) > 1 else '0'
+    rounds = 20
+
+    started = time.monotonic()
+    for i in range(rounds):
+        call(['usbrelay', '%s_1=%d'%(serial, i % 2)])
+        call(['usbrelay', '%s_2=%d'%(serial, i % 2)])
+    blocked = (time.monotonic() - started)/rounds
+    print("subprocess.call: event loop blocked %.1f ms per tick"%(1000*blocked))
+
+    async def asyncRounds():
+        board = getBoard(serial)
+        blocked = 0.0
+        for i in range(rounds):
+            started = time.monotonic()
+            board.set(1, i % 2)
+            board.set(2, i % 2)
+            blocked += time.monotonic() - started
+            await asyncio.sleep(0.2)
+        print("batched driver: event loop blocked %.3f ms per tick, %d writes in %d batches, %.1f ms per batch"%(
+              1000*blocked/rounds, board.relayWrites, board.batches, 1000*board.writeTimeSum/max(board.batches, 1)))
+
+    asyncio.get_event_loop().run_until_complete(asyncRounds())
@@ -1,40 +1,119 @@
+"""
+1-Wire temperature sensors (e.g. the ds18b20)
+
+All W1Sensors are read by one bus manager. Whenever a sensor is due to be polled
+(see polling) it starts the conversion of
+all thermometers on each bus master at once through the kernel's therm_bulk_read,
+so a sweep takes one conversion time however many sensors there are, then reads all
+results in one pass and publishes them as temperature events. Masters without bulk
+conversion support fall back to reading the sensors one by one. Devices found on the
+buses but not configured are logged, so their ids can be copied into the configuration.
+"""
 import logging
-import aiofiles
 import asyncio
 import re
+import time
 from interfaces import Sensor
 from event import notify, Event
+from hal import w1
+from scheduler import scheduler
+import calibration
+import polling
 
 logger = logging.getLogger(__name__)
 
+DISCOVERY_INTERVAL = 60.0
+
 def factory(name, settings):
     id = settings['id']
-    offset = settings.get('offset', 0.0)
-    pollInterval = settings.get('pollInterval', 2.0)
-    return W1Sensor(name, id, offset, pollInterval)
+    return W1Sensor(name, id, calibration.fromSettings(settings), polling.fromSettings(settings, 2.0))
+
+class W1BusManager:
+    def __init__(self):
+        self.sensors = {}
+        self.masters = {}
+        self.discovered = float('-inf')
+        self.started = False
+        self.sweeping = False
+        self.sweeps = 0
+        self.sweepTime = 0.0
+
+    def add(self, sensor):
+        self.sensors[sensor.sensorId] = sensor
+        w1.bus().attach(sensor.sensorId)
+        if not self.started:
+            self.started = True
+            # Once every sensor of the configuration has been added
+            asyncio.get_event_loop().call_soon(self.start)
+
+    def start(self):
+        # Sweeps when at least one sensor is due, which is checked as often as the
+        # most frequently polled sensor may be read
+        interval = min(sensor.poller.minInterval for sensor in self.sensors.values())
+        scheduler.add('w1', self.sweep, max(interval, w1.CONVERSION_TIME))
+
+    def discover(self):
+        bus = w1.bus()
+        self.masters = {master: bus.devices(master) for master in bus.masters()}
+        self.discovered = time.monotonic()
+        found = set(sensorId for devices in self.masters.values() for sensorId in devices)
+        for sensorId in sorted(found - set(self.sensors)):
+            logger.info("Found unconfigured 1-Wire device %s", sensorId)
+        for sensorId in sorted(set(self.sensors) - found):
+            logger.warning("1-Wire device %s of %s not found", sensorId, self.sensors[sensorId].name)
+
+    async def sweep(self):
+        now = time.monotonic()
+        if self.sweeping or not any(sensor.poller.isDue(now) for sensor in self.sensors.values()):
+            return
+        self.sweeping = True
+        started = time.monotonic()
+        try:
+            if started - self.discovered > DISCOVERY_INTERVAL:
+                self.discover()
+            await asyncio.gather(*[self.sweepMaster(master, devices) for (master, devices) in self.masters.items()])
+        finally:
+            self.sweeping = False
+        self.sweeps += 1
+        self.sweepTime = time.monotonic() - started
+
+    async def sweepMaster(self, master, devices):
+        sensors = [self.sensors[sensorId] for sensorId in devices if sensorId in self.sensors]
+        if not sensors:
+            return
+        bus = w1.bus()
+        try:
+            bulk = await bus.bulkConvert(master)
+        except OSError as e:
+            logger.warning("Bulk conversion on %s failed: %s", master, str(e))
+            bulk = False
+        for sensor in sensors:
+            try:
+                if bulk:
+                    sensor.update((await bus.readTemperature(sensor.sensorId))/1000.0)
+                else:
+                    sensor.update(await sensor.readTemp())
+            except (RuntimeError, OSError) as e:
+                logger.debug(str(e))
+
+manager = W1BusManager()
 
 class W1Sensor(Sensor):
-    def __init__(self, name, sensorId, offset=0, pollInterval=0):
+    def __init__(self, name, sensorId, curve=None, poller=None):
         self.name = name
         self.sensorId = sensorId
-        self.offset = offset
+        self.calibration = curve or calibration.Calibration()
         self.lastTemp = 0.0
-        self.pollInterval = pollInterval
-        asyncio.get_event_loop().create_task(self.run())
+        self.poller = poller or polling.Poller(2.0)
+        manager.add(self)
 
-
-    async def run(self):
-        while True:
-            try:
-                self.lastTemp = await self.readTemp() + self.offset
-                notify(Event(source=self.name, endpoint='temperature', data=self.lastTemp))
-            except RuntimeError as e:
-                logger.debug(str(e))
-            await asyncio.sleep(self.pollInterval)
+    def update(self, temperature):
+        self.lastTemp = self.calibration.apply(temperature)
+        self.poller.update(self.lastTemp)
+        notify(Event(source=self.name, endpoint='temperature', data=self.lastTemp))
 
     async def readTemp(self):
-        async with aiofiles.open('/sys/bus/w1/devices/%s/w1_slave'% self.sensorId, mode='r') as sensor_file:
-            contents = await sensor_file.read()
+        contents = await w1.bus().read(self.sensorId)
         match = re.search('YES\n.*=(.*)$', contents)
         if match is None:
             raise RuntimeError("Failed to read W1 Temperature: %s"%contents)
@@ -42,3 +121,23 @@ class W1Sensor(Sensor):
 
     def temp(self):
         return self.lastTemp
+
+if __name__ == '__main__':
+    # Compares a sweep over ten sensors on the simulated bus, reading them one by one
+    # as each W1Sensor did and with one bulk conversion
+    import hal
+    sensorIds = ['28-%012x'%i for i in range(10)]
+    hal.configure({'backend': hal.SIMULATED, 'values': {sensorId: 20.0 + i for (i, sensorId) in enumerate(sensorIds)}})
+    manager.started = True
+    sensors = [W1Sensor('probe%d'%i, sensorId) for (i, sensorId) in enumerate(sensorIds)]
+
+    async def benchmark():
+        started = time.monotonic()
+        for sensor in sensors:
+            await sensor.readTemp()
+        print("one by one: %.2f s per sweep"%(time.monotonic() - started))
+        manager.discover()
+        await manager.sweep()
+        print("bulk:       %.2f s per sweep"%manager.sweepTime)
+
+    asyncio.get_event_loop().run_until_complete(benchmark())
@@ -1,9 +1,34 @@
+"""
+iSpindel hydrometers, posting their readings over HTTP
+
+All iSpindels post to one endpoint, /ispindel (or /ispindel/<name>, as configured
+on older setups), and the gateway routes each reading to the sensor configured for
+the iSpindel's name or ID. A relay or gateway forwarding readings of several
+iSpindels can post them as one JSON array. Only the channels configured for a
+sensor (by default temperature, gravity, angle and battery) are kept and
+published, so keys like ID and token do not become events. The body is parsed with
+orjson or ujson when one of them is installed.
+"""
 import asyncio
 import logging
 
 from aiohttp import web
 import json
 
+try:
+    import orjson
+    loads = orjson.loads
+    parser = 'orjson'
+except ImportError:
+    try:
+        import ujson
+        loads = ujson.loads
+        parser = 'ujson'
+    except ImportError:
+        def loads(body):
+            return json.loads(body.decode('utf-8'))
+        parser = 'json'
+
 import interfaces
 from common import app
 from event import notify, Event
@@ -13,11 +38,65 @@ logger = logging.getLogger(__name__)
 def factory(name, settings  ):
     return iSpindelSensor(name, settings)
 
+class Gateway:
+    def __init__(self):
+        self.byName = {}
+        self.byId = {}
+        self.installed = False
+        self.readings = 0
+        self.unknown = 0
+
+    def add(self, sensor):
+        self.byName[sensor.ispindelName] = sensor
+        if sensor.ispindelId is not None:
+            self.byId[str(sensor.ispindelId)] = sensor
+        if not self.installed:
+            self.install(app)
+
+    def install(self, application):
+        application.router.add_post('/ispindel', self.post_handler)
+        application.router.add_post('/ispindel/{name}', self.post_handler)
+        self.installed = True
+
+    def route(self, reading, name=None):
+        sensor = self.byName.get(name or reading.get('name'))
+        if sensor is None and 'ID' in reading:
+            sensor = self.byId.get(str(reading['ID']))
+        if sensor is None:
+            self.unknown += 1
+            return False
+        self.readings += 1
+        sensor.update(reading)
+        return True
+
+    async def post_handler(self, request):
+        name = request.match_info.get('name')
+        try:
+            data = loads(await request.read())
+        except ValueError as e:
+            logger.warning('Malformed JSON received from iSpindel %s: %s'%(name or request.remote, str(e)))
+            raise web.HTTPBadRequest(reason='Malformed JSON %s'%str(e))
+        if isinstance(data, list):
+            accepted = sum(1 for reading in data if isinstance(reading, dict) and self.route(reading))
+            return web.json_response({'accepted': accepted, 'unknown': len(data) - accepted})
+        if not isinstance(data, dict) or not self.route(data, name):
+            logger.warning('Reading from unknown iSpindel %s'%(name or str(data)[:100]))
+            raise web.HTTPNotFound(reason='Unknown iSpindel')
+        return web.Response(text="Thank you")
+
+gateway = Gateway()
+
 class iSpindelSensor(interfaces.Sensor):
+    channels = (('temperature', 'temp'), ('gravity', 'gravity'), ('angle', 'angle'), ('battery', 'battery'))
+
     def __init__(self, name, settings):
         self.name = name
+        self.ispindelName = settings.get('ispindelName', name)
+        self.ispindelId = settings.get('id')
+        self.published = tuple(settings.get('channels', [channel for (channel, method) in self.channels]))
         self.last_temperature = 0
-        app.router.add_post('/ispindel/%s'%name, self.post_handler)
+        self.lastValues = {}
+        gateway.add(self)
 
     async def run(self):
         while True:
@@ -25,15 +104,66 @@ class iSpindelSensor(interfaces.Sensor):
 
     async def readTemp(self):
         self.last_temperature
-    
-    async def post_handler(self, request):
-        try:
-            data = await request.json()
-            self.last_temperature = data['temperature']
-            for key, value in data.items():
-                notify(Event(source=self.name, endpoint=key, data=value))
-            
-            return web.Response(text="Thank you")
-        except json.JSONDecodeError as e:
-            logger.warning('Malformed JSON received from iSpindel %s: %s'%(self.name, str(e)))
-            raise web.HTTPBadRequest(reason='Malformed JSON %s'%str(e))
+
+    def temp(self):
+        return self.last_temperature
+
+    def gravity(self):
+        return self.lastValues.get('gravity')
+
+    def angle(self):
+        return self.lastValues.get('angle')
+
+    def battery(self):
+        return self.lastValues.get('battery')
+
+    def update(self, reading):
+        for channel in self.published:
+            if channel in reading:
+                value = reading[channel]
+                self.lastValues[channel] = value
+                notify(Event(source=self.name, endpoint=channel, data=value))
+        self.last_temperature = self.lastValues.get('temperature', self.last_temperature)
+
+if __name__ == '__main__':
+    # Load test: posts readings of 20 iSpindels to a local gateway from 16 concurrent
+    # clients for a few seconds, one reading per post and in batches of 20
+    import sys
+    import time
+    import aiohttp
+
+    sensors = [iSpindelSensor('iSpindel%d'%i, {'id': 1000 + i}) for i in range(20)]
+    reading = {'name': 'iSpindel0', 'ID': 1000, 'token': 'tfbrew', 'angle': 52.1, 'temperature': 19.4,
+               'temp_units': 'C', 'battery': 4.05, 'gravity': 1.042, 'interval': 900, 'RSSI': -71}
+    readings = [dict(reading, name='iSpindel%d'%i, ID=1000 + i) for i in range(20)]
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+
+    async def client(session, url, bodies, deadline, counts):
+        i = 0
+        while time.monotonic() < deadline:
+            async with session.post(url, data=bodies[i % len(bodies)]) as response:
+                await response.read()
+                counts[response.status == 200] += 1
+            i += 1
+
+    async def loadTest():
+        application = web.Application()
+        gateway.install(application)
+        runner = web.AppRunner(application)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        url = 'http://127.0.0.1:%d/ispindel'%port
+        async with aiohttp.ClientSession() as session:
+            for (label, bodies, perPost) in (('single', [json.dumps(r) for r in readings], 1),
+                                             ('batched', [json.dumps(readings)], len(readings))):
+                counts = [0, 0]
+                started = time.monotonic()
+                await asyncio.gather(*[client(session, url, bodies, started + duration, counts) for i in range(16)])
+                elapsed = time.monotonic() - started
+                print("%-8s %7.0f posts/s, %8.0f readings/s, %d failed (%s)"%(
+                      label, counts[1]/elapsed, perPost*counts[1]/elapsed, counts[0], parser))
+        await runner.cleanup()
+
+    asyncio.get_event_loop().run_until_complete(loadTest())
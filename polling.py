@@ -0,0 +1,117 @@
+"""
+Adaptive poll intervals for polled sensors
+
+A Poller decides how long a sensor waits before its next reading. A fixed poller
+always waits pollInterval. An adaptive one, configured with minPollInterval and
+maxPollInterval, polls often while the reading changes fast or is far from the
+setpoint of the controller using the sensor, and backs off, gradually, while it is
+steady near it:
+
+- rate: the interval in which the reading is expected to change by resolution
+- setpoint: maxInterval scaled down by how many bands the reading is away from it
+"""
+import asyncio
+import math
+import time
+
+BACKOFF = 1.5
+
+class Poller:
+    def __init__(self, minInterval, maxInterval=None, resolution=0.1, band=1.0):
+        self.minInterval = minInterval
+        self.maxInterval = minInterval if maxInterval is None else max(minInterval, maxInterval)
+        self.resolution = resolution
+        self.band = band
+        self.target = None
+        self.interval = self.minInterval
+        self.lastValue = None
+        self.lastTime = None
+        self.due = float('-inf')
+        self.rescheduled = asyncio.Event()
+
+    def adaptive(self):
+        return self.maxInterval > self.minInterval
+
+    def setpoint(self, setpoint):
+        """
+        Sets the setpoint the sensor is controlled to, and polls again soon
+        """
+        if setpoint != self.target:
+            self.target = setpoint
+            self.interval = self.minInterval
+            self.due = min(self.due, time.monotonic() + self.minInterval)
+            self.rescheduled.set()
+
+    def nextInterval(self, value, now):
+        limit = self.maxInterval
+        if self.lastValue is not None and now > self.lastTime:
+            rate = abs(value - self.lastValue)/(now - self.lastTime)
+            if rate > 0:
+                limit = min(limit, self.resolution/rate)
+        if self.target is not None:
+            distance = abs(value - self.target)
+            if distance > self.band:
+                limit = min(limit, self.maxInterval*self.band/distance)
+        # Speeds up at once but backs off gradually, so a single steady reading
+        # during a fast change does not stretch the interval all the way
+        return min(max(limit, self.minInterval), self.interval*BACKOFF)
+
+    def update(self, value, now=None):
+        """
+        Takes in a reading and returns the number of seconds until the next one
+        """
+        if now is None:
+            now = time.monotonic()
+        if self.adaptive() and value is not None and not math.isnan(value):
+            self.interval = self.nextInterval(value, now)
+            self.lastValue = value
+            self.lastTime = now
+        self.due = now + self.interval
+        return self.interval
+
+    async def wait(self):
+        """
+        Sleeps until the next reading is due, waking up early when a new setpoint
+        brings it forward
+        """
+        while True:
+            delay = self.due - time.monotonic()
+            if delay <= 0:
+                return
+            self.rescheduled.clear()
+            try:
+                await asyncio.wait_for(self.rescheduled.wait(), delay)
+            except asyncio.TimeoutError:
+                return
+
+    def isDue(self, now=None):
+        return (time.monotonic() if now is None else now) >= self.due
+
+    def stats(self):
+        return {'interval': self.interval, 'minInterval': self.minInterval, 'maxInterval': self.maxInterval}
+
+def fromSettings(settings, pollInterval):
+    """
+    Makes the poller configured in a sensor's settings: adaptive if minPollInterval
+    and maxPollInterval are given, otherwise fixed at pollInterval (or the given default)
+    """
+    if 'minPollInterval' in settings and 'maxPollInterval' in settings:
+        return Poller(settings['minPollInterval'], settings['maxPollInterval'],
+                      settings.get('pollResolution', 0.1), settings.get('pollBand', 1.0))
+    return Poller(settings.get('pollInterval', pollInterval))
+
+if __name__ == '__main__':
+    # Number of readings over a simulated mash: heating to a 67 C strike temperature
+    # at 1 C/min, then an hour steady
+    def simulate(poller):
+        polls = 0
+        now = 0.0
+        poller.setpoint(67.0)
+        while now < 7200:
+            temperature = min(20.0 + now/60.0, 67.0)
+            now += poller.update(temperature, now)
+            polls += 1
+        return polls
+
+    for poller in (Poller(2.0), Poller(2.0, 60.0)):
+        print("%s: %d readings"%('adaptive' if poller.adaptive() else 'fixed 2 s', simulate(poller)))
@@ -0,0 +1,127 @@
+"""
+Conversion of platinum RTD readings to temperature
+
+The Callendar-Van Dusen equation (IEC 60751) gives the resistance of the RTD at a
+temperature t:
+
+    R(t) = R0 (1 + A t + B t^2)                     for t >= 0
+    R(t) = R0 (1 + A t + B t^2 + C (t - 100) t^3)   for t < 0
+
+Rather than inverting it for every sample, RTDTable inverts it once, with Newton's
+method over the whole range including below 0 C, at every STEP-th code of the
+converter's 15 bit ratio of RTD to reference resistance. A code in the table is then
+a single lookup, and other codes (e.g. averaged ones) are interpolated linearly,
+with an error well below 1 mC. Many codes can be converted at once, with NumPy when
+it is installed.
+"""
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CVD_A = 3.9083e-3
+CVD_B = -5.775e-7
+CVD_C = -4.183e-12
+
+CODES = 1 << 15
+STEP = 1
+
+def resistance(temperature, r0=100.0):
+    ratio = 1 + CVD_A*temperature + CVD_B*temperature**2
+    if temperature < 0:
+        ratio += CVD_C*(temperature - 100)*temperature**3
+    return r0*ratio
+
+def temperature(rt, r0=100.0):
+    """
+    Inverts the Callendar-Van Dusen equation, starting from the root of its
+    quadratic part, which is exact at and above 0 C
+    """
+    t = (-CVD_A + (CVD_A**2 - 4*CVD_B*(1 - rt/r0))**0.5)/(2*CVD_B)
+    if t < 0:
+        for i in range(20):
+            slope = r0*(CVD_A + 2*CVD_B*t + CVD_C*(4*t**3 - 300*t**2))
+            delta = (resistance(t, r0) - rt)/slope
+            t -= delta
+            if abs(delta) < 1e-9:
+                break
+    return t
+
+class RTDTable:
+    def __init__(self, rref=430.0, r0=100.0, step=STEP):
+        self.rref = rref
+        self.r0 = r0
+        self.step = step
+        self.table = array('d', (temperature(code*rref/CODES, r0) for code in range(0, CODES + step, step)))
+        if numpy is not None:
+            self.nodes = numpy.arange(0, CODES + step, step, dtype=float)
+            self.values = numpy.frombuffer(self.table, dtype=float)
+
+    def temperature(self, code):
+        """
+        Returns the temperature for a 15 bit code (RTD resistance/rref*32768)
+        """
+        if self.step == 1 and code.__class__ is int:
+            return self.table[code]
+        index = min(int(code//self.step), len(self.table) - 2)
+        fraction = code - index*self.step
+        low = self.table[index]
+        if fraction == 0:
+            return low
+        return low + (self.table[index + 1] - low)*fraction/self.step
+
+    def temperatures(self, codes):
+        """
+        Converts a sequence of codes, returning a NumPy array when NumPy is installed
+        """
+        if numpy is not None:
+            codes = numpy.asarray(codes)
+            if self.step == 1 and codes.dtype.kind in 'iu':
+                return self.values[codes]
+            return numpy.interp(codes, self.nodes, self.values)
+        return [self.temperature(code) for code in codes]
+
+tables = {}
+
+def getTable(rref, r0):
+    """
+    Returns the table for the reference and 0 C resistances, built on first use
+    """
+    key = (float(rref), float(r0))
+    if key not in tables:
+        tables[key] = RTDTable(rref, r0)
+    return tables[key]
+
+if __name__ == '__main__':
+    import math
+    import time
+    import random
+
+    def quadratic(code, rref=430.0, r0=100.0):
+        # The conversion RTDSensor used to do for every sample
+        rt = (code*rref) / 32768.0
+        temp_C = -CVD_A*r0 + math.sqrt(r0**2*CVD_A**2 - 4*r0*CVD_B*(r0-rt))
+        temp_C /= 2*r0*CVD_B
+        if (temp_C < 0):
+            temp_C = (code/32) - 256
+        return temp_C
+
+    started = time.perf_counter()
+    table = getTable(430.0, 100.0)
+    print("table built in %.1f ms"%(1000*(time.perf_counter() - started)))
+
+    worst = max(abs(table.temperature(code + 0.5) - temperature((code + 0.5)*430.0/CODES)) for code in range(1000, CODES - 1, 7))
+    print("interpolation error at most %.2g C"%worst)
+    for t in (-200.0, -40.0, -10.0, 0.0, 67.0, 400.0):
+        code = resistance(t)/430.0*CODES
+        print("%7.1f C: table %8.3f C, previous formula %8.3f C"%(t, table.temperature(code), quadratic(code)))
+
+    codes = array('l', (random.randrange(5000, 12000) for i in range(100000)))
+    for (label, convert) in (('math.sqrt per sample', lambda: [quadratic(code) for code in codes]),
+                             ('table per sample', lambda: [table.temperature(code) for code in codes]),
+                             ('table batched', lambda: table.temperatures(codes))):
+        started = time.perf_counter()
+        convert()
+        print("%-20s %6.1f ns/sample"%(label, 1e9*(time.perf_counter() - started)/len(codes)))
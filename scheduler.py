@@ -0,0 +1,116 @@
+"""
+Shared fixed-rate scheduler for periodic control ticks
+
+Every job runs on deadlines that are a whole number of intervals after its first one,
+so the time a tick takes does not make the job drift. Jobs are staggered within their
+interval so that many controllers do not all tick at the same moment, and the deadlines
+are kept in the event loop's own timer heap rather than in one task per job.
+"""
+import asyncio
+import logging
+import math
+
+from aiohttp import web
+
+from common import app
+
+# Fraction of the interval between the phases of consecutively added jobs (golden ratio),
+# which spreads any number of jobs evenly over the interval
+PHASE_STEP = (math.sqrt(5) - 1)/2
+
+logger = logging.getLogger(__name__)
+
+class Job:
+    def __init__(self, name, callback, interval):
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.deadline = None
+        self.handle = None
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.jitterSum = 0.0
+        self.jitterMax = 0.0
+        self.durationSum = 0.0
+        self.durationMax = 0.0
+
+    def stats(self):
+        ticks = max(self.ticks, 1)
+        return {
+            'interval': self.interval,
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'skippedTicks': self.skipped,
+            'jitterMean': self.jitterSum/ticks,
+            'jitterMax': self.jitterMax,
+            'durationMean': self.durationSum/ticks,
+            'durationMax': self.durationMax
+        }
+
+class Scheduler:
+    def __init__(self):
+        self.jobs = {}
+
+    def add(self, name, callback, interval, delay=0.0, phase=None):
+        """
+        Runs callback every interval seconds, first after delay plus a phase offset.
+        phase is a fraction of the interval; by default jobs are spread over the interval.
+        Coroutine functions are started as tasks and not waited for.
+        """
+        if interval <= 0:
+            raise ValueError('interval must be greater than 0')
+        if phase is None:
+            phase = (len(self.jobs)*PHASE_STEP) % 1.0
+        loop = asyncio.get_event_loop()
+        job = Job(name, callback, interval)
+        job.deadline = loop.time() + delay + phase*interval
+        job.handle = loop.call_at(job.deadline, self._fire, job)
+        self.jobs[name] = job
+        return job
+
+    def remove(self, name):
+        job = self.jobs.pop(name)
+        job.handle.cancel()
+
+    def _fire(self, job):
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        jitter = started - job.deadline
+        try:
+            if asyncio.iscoroutinefunction(job.callback):
+                asyncio.ensure_future(job.callback())
+            else:
+                job.callback()
+        except Exception:
+            logger.exception("Tick of %s failed", job.name)
+        finished = loop.time()
+        duration = finished - started
+
+        job.ticks += 1
+        job.jitterSum += jitter
+        job.jitterMax = max(job.jitterMax, jitter)
+        job.durationSum += duration
+        job.durationMax = max(job.durationMax, duration)
+
+        if duration >= job.interval:
+            job.overruns += 1
+        job.deadline += job.interval
+        if job.deadline <= finished:
+            # Fell behind, by its own tick or by being started late: skip the deadlines
+            # already missed instead of running them back to back
+            missed = math.floor((finished - job.deadline)/job.interval) + 1
+            job.deadline += missed*job.interval
+            job.skipped += missed
+            logger.warning("%s fell behind its %g s interval, skipped %d ticks", job.name, job.interval, missed)
+        job.handle = loop.call_at(job.deadline, self._fire, job)
+
+    def stats(self):
+        return {name: job.stats() for (name, job) in self.jobs.items()}
+
+scheduler = Scheduler()
+
+async def schedulerStats(request):
+    return web.json_response(scheduler.stats())
+
+app.router.add_get('/scheduler', schedulerStats)
@@ -17,11 +17,48 @@ var plotComp = {
     data: function() {
         return {
             ctx: null,
-            chart: null
+            chart: null,
+            lastTimestamp: null
         }
     },
     methods: {
+        // Loads the history from the server, or only the samples newer than the last
+        // one loaded, e.g. after the websocket reconnects
+        fetchHistory: function() {
+            var url = this.href + '?format=binary'
+            if (this.lastTimestamp != null)
+                url += '&since=' + this.lastTimestamp
+            fetch(url)
+            .then(response=>response.arrayBuffer())
+            .then(buffer =>{
+                var columns = unpackColumns(buffer)
+                if (columns.label.length == 0)
+                    return
+                this.lastTimestamp = columns.label[columns.label.length-1]
+                columns.label.forEach(x=>this.chart.data.labels.push(Math.floor(1000*x)))
+                columns.temperature.forEach(x=>this.chart.data.datasets[0].data.push(x))
+                columns.power.forEach(x=>this.chart.data.datasets[1].data.push(x))
+                columns.setpoint.forEach(x=>this.chart.data.datasets[2].data.push(x))
+                if (columns.gravity != undefined) {
+                    if (this.chart.data.datasets.length < 4) {
+                        this.chart.data.datasets.push({
+                            label: 'Gravity',
+                            fill: true,
+                            backgroundColor: chartColors.yellow,
+                            borderColor: chartColors.white,
+                            data: [],
+                            yAxisID: 'gravity-axis'
+                        })
+                    }
+                    columns.gravity.forEach(x=>this.chart.data.datasets[3].data.push(x))
+                }
+                this.chart.update()
+            })
+        },
         newData: function(datapoint) {
+            // A refetch only needs the samples after the newest one broadcast
+            if (datapoint.timestamp != null)
+                this.lastTimestamp = datapoint.timestamp
             this.chart.data.labels.push(moment(datapoint.when))
             this.chart.data.datasets[0].data.push(datapoint.temperature)
             this.chart.data.datasets[1].data.push(datapoint.power)
@@ -109,27 +146,32 @@ var plotComp = {
                 }
             }
         });  
-        fetch(this.href)
-        .then(response=>response.json())
-        .then(json =>{
-            json.label.forEach(x=>this.chart.data.labels.push(Math.floor(1000*x)))
-            json.temperature.forEach(x=>this.chart.data.datasets[0].data.push(x))
-            json.power.forEach(x=>this.chart.data.datasets[1].data.push(x))
-            json.setpoint.forEach(x=>this.chart.data.datasets[2].data.push(x))
-            if (json.gravity != undefined) {
-                this.chart.data.datasets.push({
-                    label: 'Gravity',
-                    fill: true,
-                    backgroundColor: chartColors.yellow,
-	            borderColor: chartColors.white,
-                    data: [],
-                    yAxisID: 'gravity-axis'
-                })
-                json.gravity.forEach(x=>this.chart.data.datasets[3].data.push(x))
-            }
-            this.chart.update()      
-        })
+        this.fetchHistory()
+    }
+}
+
+// Decodes the compact binary history format (see packColumns in history.py)
+// into an object of typed arrays, one per column
+function unpackColumns(buffer) {
+    var view = new DataView(buffer)
+    var count = view.getUint32(4, true)
+    var ncols = view.getUint16(8, true)
+    var offset = 12
+    var layout = []
+    for (var i = 0; i < ncols; i++) {
+        var size = view.getUint8(offset)
+        var nameLength = view.getUint8(offset+1)
+        var name = String.fromCharCode.apply(null, new Uint8Array(buffer, offset+2, nameLength))
+        layout.push([name, size])
+        offset += 2 + nameLength
     }
+    var columns = {}
+    layout.forEach(([name, size]) => {
+        offset += (8 - offset % 8) % 8
+        columns[name] = size == 8 ? new Float64Array(buffer, offset, count) : new Float32Array(buffer, offset, count)
+        offset += size*count
+    })
+    return columns
 }
 
 Vue.component('brewcontroller', {
@@ -218,6 +260,7 @@ Vue.component('brewcontroller', {
                     this.controllerState[key] = msg.data[key];
                 }
                 var datapoint = {'when': moment(), 
+                                 'timestamp': this.controllerState.timestamp,
                                  'temperature': this.controllerState.temperature,
                                  'power': this.controllerState.power, 
                                  setpoint: this.controllerState.setpoint}
@@ -229,6 +272,7 @@ Vue.component('brewcontroller', {
                 console.log("WS Close")
                 console.log(e)
                this.newWsConn(url);
+               this.$refs.chart.fetchHistory();
             };
             this.ws.onerror = (e) => {
                 console.log("WS Error: " + e)
@@ -13,6 +13,7 @@ from ruamel.yaml import YAML
 import interfaces
 import controller
 import event
+import hal
 from common import app, components
 
 yaml = YAML(typ='safe')   # default, if not specfied, is 'rt' (round-trip)
@@ -32,36 +33,58 @@ logging.getLogger('').addHandler(console)
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "plugins"))
 
+hal.configure(config.get('hal', hal.REAL))
+
 for componentType in ['sensors', 'actors', 'extensions']:
     for component in config[componentType]:
         for name, attribs in component.items():
             logging.info("setting up %s"%name)
             plugin = importlib.import_module('plugins.%s'%attribs['plugin'])
             components[name] = plugin.factory(name, attribs)
+            if 'stateRefreshInterval' in attribs:
+                components[name].stateRefreshInterval = attribs['stateRefreshInterval']
+            publish = attribs.get('publish')
+            if publish and all(isinstance(settings, dict) for settings in publish.values()):
+                for (endpoint, settings) in publish.items():
+                    event.setPolicy(name, event.policyFromSettings(settings), endpoint)
+            elif publish:
+                event.setPolicy(name, event.policyFromSettings(publish))
 for ctrl in config['controllers']:
     for name, attribs in ctrl.items():
         logger.info("setting up %s"%name)
+        interval = attribs.get('interval', controller.CONTROL_INTERVAL)
         logicPlugin = importlib.import_module('plugins.%s'%attribs['plugin'])
-        logic = logicPlugin.factory(name, attribs['logicCoeffs'])
+        logic = logicPlugin.factory(name, dict({'sampleTime': interval}, **attribs['logicCoeffs']))
         sensor = components[attribs['sensor']]
         actor = components[attribs['actor']]
         agitator = components.get(attribs.get('agitator', ''),None)
         initialSetpoint = attribs.get('initialSetpoint', 67.0)
         initiallyEnabled = True if attribs.get('initialState', 'on') == 'on' else 'off'
-        components[name] = controller.Controller(name, sensor, actor, logic, agitator, initialSetpoint, initiallyEnabled)
+        historySize = attribs.get('historySize', controller.HISTORY_SIZE)
+        historyFile = attribs.get('historyFile', os.path.join(config['historyDir'], '%s.tfts'%name) if 'historyDir' in config else None)
+        components[name] = controller.Controller(name, sensor, actor, logic, agitator, initialSetpoint, initiallyEnabled, historySize, historyFile, interval)
 
 
+eventBus = config.get('eventBus', {})
 for conn in config['connections']:
+    # Either "source.endpoint=>component.endpoint" or that mapped to its publish policy
+    policy = None
+    if isinstance(conn, dict):
+        ((conn, publish),) = conn.items()
+        policy = event.policyFromSettings(publish)
     (sendEvent, recvEvent) = conn.split('=>')
     (sendComponent, sendType) = sendEvent.split('.')
     (recvComponent, recvType) = recvEvent.split('.')
-    event.register(sendEvent, lambda event, rc=recvComponent, rt=recvType: components[rc].callback(rt, event))
+    event.register(sendEvent, lambda event, rc=recvComponent, rt=recvType: components[rc].callback(rt, event),
+                   queueSize=eventBus.get('queueSize', 0), overflow=eventBus.get('overflow', event.DROP_OLDEST), label=conn, policy=policy)
 
 async def start_background_tasks(app):
     pass
 
 async def cleanup_background_tasks(app):
-    pass
+    for component in components.values():
+        if isinstance(component, controller.Controller) and component.store is not None:
+            component.store.close()
 
 app.on_startup.append(start_background_tasks)
 app.on_cleanup.append(cleanup_background_tasks)
@@ -73,7 +96,19 @@ async def rootRouteHandler(request):
     else:
         return web.Response(text="Web UI not enabled in config.yaml")
 
+async def eventBusHandler(request):
+    return web.json_response(event.queueStats())
+
+async def publishPoliciesHandler(request):
+    return web.json_response(event.policyStats())
+
+async def actorsHandler(request):
+    return web.json_response({name: component.writeStats() for (name, component) in components.items() if isinstance(component, interfaces.Actor)})
+
 app.router.add_get('/', rootRouteHandler)
+app.router.add_get('/eventbus', eventBusHandler)
+app.router.add_get('/eventbus/policies', publishPoliciesHandler)
+app.router.add_get('/actors', actorsHandler)
 
 if isWebUIenabled:
     app.router.add_static('/static', 'static/')
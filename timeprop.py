@@ -0,0 +1,211 @@
+"""
+Time-proportioning of on/off actors
+
+A power between 0 and 100% is turned into switching an on/off output: every cycle the
+output is on for power% of the cycle time. Outputs declare a minimum on and off time
+(a shorter pulse is dropped, a shorter gap is filled) and a phase offset within the
+cycle, so that heaters sharing a circuit do not all switch on at the same moment.
+
+All switching deadlines live in one hashed timer wheel that is advanced by the shared
+scheduler, however many outputs are registered.
+"""
+import asyncio
+import logging
+import math
+
+from aiohttp import web
+
+from common import app
+from scheduler import scheduler, PHASE_STEP
+
+WHEEL_TICK = 0.1
+WHEEL_SLOTS = 512
+
+logger = logging.getLogger(__name__)
+
+class Timer:
+    __slots__ = ('when', 'tick', 'callback', 'cancelled')
+
+    def __init__(self, when, tick, callback):
+        self.when = when
+        self.tick = tick
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class TimerWheel:
+    """
+    Hashed timer wheel: a timer due at tick t is kept in slot t % slots and fired when
+    the wheel reaches tick t, so scheduling, cancelling and firing are all O(1)
+    """
+    def __init__(self, tick=WHEEL_TICK, slots=WHEEL_SLOTS, now=0.0):
+        self.tickLength = tick
+        self.slots = [[] for i in range(slots)]
+        self.origin = now
+        self.current = 0
+
+    def schedule(self, when, callback):
+        tick = max(self.current + 1, math.ceil((when - self.origin)/self.tickLength))
+        timer = Timer(when, tick, callback)
+        self.slots[tick % len(self.slots)].append(timer)
+        return timer
+
+    def advance(self, now):
+        """
+        Fires the timers due up to now, passing each the time it was due
+        """
+        target = math.floor((now - self.origin)/self.tickLength)
+        while self.current < target:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            due = [timer for timer in slot if timer.tick <= self.current]
+            if due:
+                slot[:] = [timer for timer in slot if timer.tick > self.current]
+                for timer in due:
+                    if not timer.cancelled:
+                        timer.callback(timer.when)
+
+class Output:
+    """
+    One time-proportioned output. switch is called with True/False whenever it changes.
+    A change is held back until the output has been on for minOn or off for minOff.
+    """
+    def __init__(self, engine, name, switch, cycleTime, minOn=0.0, minOff=0.0, phase=0.0):
+        self.engine = engine
+        self.name = name
+        self.switch = switch
+        self.cycleTime = cycleTime
+        self.minOn = minOn
+        self.minOff = minOff
+        self.phase = phase
+        self.duty = 0.0
+        self.state = None
+        self.changed = None
+        self.offTimer = None
+        self.cycleTimer = None
+        self.pendingTimer = None
+
+    def onTime(self):
+        onTime = self.duty*self.cycleTime
+        if onTime < self.minOn:
+            return 0.0
+        if self.cycleTime - onTime < self.minOff:
+            return self.cycleTime
+        return onTime
+
+    def set(self, state, due=None):
+        if due is not None:
+            self.engine.recordJitter(due)
+        if state != self.state:
+            self.state = state
+            self.changed = asyncio.get_event_loop().time()
+            self.engine.switches += 1
+            self.switch(state)
+
+    def earliest(self, state, now):
+        """
+        Returns the earliest time the output may change to state
+        """
+        if self.changed is None or state == self.state:
+            return now
+        return max(now, self.changed + (self.minOn if self.state else self.minOff))
+
+    def request(self, state, due):
+        """
+        Changes to state at due, or as soon as minOn/minOff allows, and returns when
+        """
+        if self.pendingTimer is not None:
+            self.pendingTimer.cancel()
+            self.pendingTimer = None
+        when = self.earliest(state, due)
+        if when > due:
+            self.pendingTimer = self.engine.wheel.schedule(when, lambda when: self.set(state, when))
+        else:
+            self.set(state, due)
+        return when
+
+    def startCycle(self, due):
+        onTime = self.onTime()
+        start = self.request(onTime > 0, due)
+        if 0 < onTime < self.cycleTime:
+            end = max(due + onTime, start + self.minOn)
+            if end < due + self.cycleTime:
+                self.offTimer = self.engine.wheel.schedule(end, lambda when: self.set(False, when))
+        self.cycleTimer = self.engine.wheel.schedule(due + self.cycleTime, self.startCycle)
+
+    def setDuty(self, duty):
+        """
+        Sets the fraction of each cycle to be on, from the next cycle on. Fully off and
+        fully on take effect at once, or once minOn/minOff has passed, and setting the
+        same duty again resends the state.
+        """
+        duty = min(max(duty, 0.0), 1.0)
+        if duty == self.duty:
+            if self.state is not None:
+                self.switch(self.state)
+            return
+        self.duty = duty
+        if duty in (0.0, 1.0):
+            if self.offTimer is not None:
+                self.offTimer.cancel()
+            self.request(duty == 1.0, asyncio.get_event_loop().time())
+
+class TimeProportioner:
+    def __init__(self, tick=WHEEL_TICK):
+        self.tick = tick
+        self.wheel = None
+        self.outputs = {}
+        self.circuits = {}
+        self.switches = 0
+        self.timers = 0
+        self.jitterSum = 0.0
+        self.jitterMax = 0.0
+
+    def register(self, name, switch, cycleTime, minOn=0.0, minOff=0.0, phase=None, circuit=None):
+        """
+        Registers an on/off output and returns its Output, on which setDuty is called.
+        Without an explicit phase (a fraction of the cycle), outputs on the same circuit
+        are spread over the cycle.
+        """
+        loop = asyncio.get_event_loop()
+        if self.wheel is None:
+            self.wheel = TimerWheel(self.tick, now=loop.time())
+            scheduler.add('timeprop', self.advance, self.tick, phase=0.0)
+        if phase is None:
+            members = self.circuits.setdefault(circuit, [])
+            phase = (len(members)*PHASE_STEP) % 1.0
+            members.append(name)
+        output = Output(self, name, switch, cycleTime, minOn, minOff, phase)
+        self.outputs[name] = output
+        now = loop.time()
+        firstCycle = now + (phase*cycleTime - now) % cycleTime
+        output.set(False)
+        output.cycleTimer = self.wheel.schedule(firstCycle, output.startCycle)
+        return output
+
+    def advance(self):
+        self.wheel.advance(asyncio.get_event_loop().time())
+
+    def recordJitter(self, due):
+        jitter = max(0.0, asyncio.get_event_loop().time() - due)
+        self.timers += 1
+        self.jitterSum += jitter
+        self.jitterMax = max(self.jitterMax, jitter)
+
+    def stats(self):
+        return {
+            'outputs': len(self.outputs),
+            'switches': self.switches,
+            'timers': self.timers,
+            'jitterMean': self.jitterSum/max(self.timers, 1),
+            'jitterMax': self.jitterMax
+        }
+
+engine = TimeProportioner()
+
+async def timepropStats(request):
+    return web.json_response(engine.stats())
+
+app.router.add_get('/timeprop', timepropStats)
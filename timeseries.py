@@ -0,0 +1,172 @@
+"""
+Append-only, memory-mapped columnar store for controller samples
+
+The file starts with a fixed size header (magic, version, rows per chunk, column
+names and the number of stored rows) followed by chunks of chunkRows rows, each chunk
+holding its columns as contiguous little-endian float64 runs. Opening a store only
+reads the header, and since samples are appended in time order the timestamp column
+itself is the index: a from/to query bisects it through the mapping, touching
+O(log n) pages, and then copies out just the requested rows.
+"""
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'TFTS'
+VERSION = 1
+HEADER_SIZE = 4096
+HEADER = struct.Struct('<4sIIIQ')
+COUNT_OFFSET = HEADER.size - 8
+DOUBLE = struct.Struct('<d')
+
+class TimeView:
+    """
+    Read-only sequence over the timestamp column, for bisecting
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.count
+
+    def __getitem__(self, row):
+        return DOUBLE.unpack_from(self.store.mm, self.store.offset(row, 0))[0]
+
+class TimeSeriesStore:
+    def __init__(self, path, columns, chunkRows=4096, timeColumn='timestamp'):
+        self.path = path
+        self.columnNames = [timeColumn] + [name for name in columns if name != timeColumn]
+        self.chunkRows = chunkRows
+        self.file = None
+        self.mm = None
+        if os.path.exists(path):
+            self._open()
+        else:
+            self._create()
+
+    def _create(self):
+        names = ','.join(self.columnNames).encode('ascii')
+        if HEADER.size + len(names) > HEADER_SIZE:
+            raise ValueError('Too many columns for %s'%self.path)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.chunkRows, len(self.columnNames), 0) + names)
+            f.truncate(HEADER_SIZE + self._chunkBytes())
+        self._open()
+
+    def _readHeader(self):
+        """
+        Returns (chunkRows, count) from the header, or None if the file is not a store of
+        these columns or is cut short (e.g. by a crash while it was created)
+        """
+        with open(self.path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+            size = os.fstat(f.fileno()).st_size
+        try:
+            (magic, version, chunkRows, ncols, count) = HEADER.unpack_from(header)
+            names = header[HEADER.size:].split(b'\0', 1)[0].decode('ascii').split(',')
+        except (struct.error, UnicodeDecodeError):
+            return None
+        if magic != MAGIC or version != VERSION or names != self.columnNames or chunkRows == 0:
+            return None
+        chunks = -(-count//chunkRows)
+        if size < HEADER_SIZE + chunks*8*chunkRows*len(names):
+            return None
+        return (chunkRows, count)
+
+    def _open(self):
+        header = self._readHeader()
+        if header is None:
+            stale = '%s.%d'%(self.path, int(time.time()))
+            logger.warning("%s is unreadable or does not match columns %s, moving it to %s"%(self.path, self.columnNames, stale))
+            os.rename(self.path, stale)
+            self._create()
+            return
+        (self.chunkRows, self.count) = header
+        self.file = open(self.path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+
+    def _chunkBytes(self):
+        return 8*self.chunkRows*len(self.columnNames)
+
+    def _grow(self):
+        size = len(self.mm) + self._chunkBytes()
+        self.mm.close()
+        self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+
+    def offset(self, row, col):
+        (chunk, index) = divmod(row, self.chunkRows)
+        return HEADER_SIZE + chunk*self._chunkBytes() + 8*(col*self.chunkRows + index)
+
+    def __len__(self):
+        return self.count
+
+    def lastTimestamp(self):
+        return TimeView(self)[self.count-1] if self.count else float('-inf')
+
+    def append(self, values):
+        """
+        Appends a sample, values maps column names to numbers. Missing columns are stored as NaN.
+        Timestamps must not decrease; a timestamp older than the last one is clamped to it.
+        """
+        if HEADER_SIZE + (self.count//self.chunkRows + 1)*self._chunkBytes() > len(self.mm):
+            self._grow()
+        row = self.count
+        timestamp = max(values[self.columnNames[0]], self.lastTimestamp())
+        DOUBLE.pack_into(self.mm, self.offset(row, 0), timestamp)
+        for (col, name) in enumerate(self.columnNames[1:], 1):
+            DOUBLE.pack_into(self.mm, self.offset(row, col), values.get(name, float('nan')))
+        self.count += 1
+        struct.pack_into('<Q', self.mm, COUNT_OFFSET, self.count)
+
+    def rows(self, start=None, end=None, since=None):
+        """
+        Returns the (first, last+1) row numbers of samples with start <= timestamp <= end
+        and since < timestamp
+        """
+        times = TimeView(self)
+        first = 0 if start is None else bisect_left(times, start)
+        if since is not None:
+            first = max(first, bisect_right(times, since))
+        last = self.count if end is None else bisect_right(times, end, first)
+        return (first, last)
+
+    def column(self, col, first, last):
+        values = array('d')
+        row = first
+        while row < last:
+            rowsInChunk = min(last, (row//self.chunkRows + 1)*self.chunkRows) - row
+            begin = self.offset(row, col)
+            values.frombytes(self.mm[begin:begin + 8*rowsInChunk])
+            row += rowsInChunk
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    def range(self, start=None, end=None, since=None):
+        """
+        Returns the samples with start <= timestamp <= end and since < timestamp
+        as a dict of column name to array('d')
+        """
+        (first, last) = self.rows(start, end, since)
+        return {name: self.column(col, first, last) for (col, name) in enumerate(self.columnNames)}
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.file.close()
+            self.mm = None